@@ -0,0 +1,274 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Thread
+
+import yaml
+# ============= local library imports  ==========================
+from readiness import probe_tcp, wait_for
+
+# device: list of (command, weight)
+DEFAULT_MIX = {'Valve': [('Open A', 1), ('Close A', 1)],
+               'Laser': [('Enable', 1), ('Disable', 1), ('MoveToPosition 1', 1)],
+               'Spectrometer': [('GetData', 4), ('GetDAC', 1), ('SetDAC 10', 1)]}
+TERMINATOR = '\r\n'
+
+
+def percentile(values, q):
+    """
+    <values> must be sorted
+    """
+    if not values:
+        return 0
+    idx = min(int(round(q * (len(values) - 1))), len(values) - 1)
+    return values[idx]
+
+
+def summarize(latencies, errors, duration):
+    latencies.sort()
+    n = len(latencies)
+    return {'requests': n,
+            'errors': errors,
+            'throughput': n / duration if duration else 0,
+            'mean': sum(latencies) / n if n else 0,
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if n else 0}
+
+
+class Client(Thread):
+    """
+    one connection replaying a weighted command mix until <deadline>. with
+    <pipeline> > 1 that many commands are written before the replies are read
+    """
+
+    def __init__(self, host, port, mix, deadline, pipeline=1, seed=None):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.host = host
+        self.port = port
+        self.deadline = deadline
+        self.pipeline = pipeline
+        self.latencies = []
+        self.errors = 0
+
+        # expand the weights once so picking a command is a single choice()
+        self._commands = [c for c, w in mix for _ in range(int(w))]
+        self._rng = random.Random(seed)
+
+    def run(self):
+        sock = socket.create_connection((self.host, self.port))
+        sock.settimeout(10)
+        buf = ''
+        try:
+            while time.time() < self.deadline:
+                cmds = [self._rng.choice(self._commands) for _ in range(self.pipeline)]
+                st = time.time()
+                sock.sendall(''.join('{}{}'.format(c, TERMINATOR) for c in cmds))
+                for _ in cmds:
+                    while TERMINATOR not in buf:
+                        data = sock.recv(65536)
+                        if not data:
+                            raise socket.error('connection closed')
+                        buf += data
+                    resp, buf = buf.split(TERMINATOR, 1)
+                    self.latencies.append(time.time() - st)
+                    if resp.startswith('Invalid Command'):
+                        self.errors += 1
+        except socket.error:
+            self.errors += 1
+        finally:
+            sock.close()
+
+
+def run_level(host, ports, mixes, nclients, duration, pipeline):
+    deadline = time.time() + duration
+    clients = {}
+    for device, port in ports.items():
+        clients[device] = [Client(host, port, mixes[device], deadline, pipeline, seed=i)
+                           for i in range(nclients)]
+
+    st = time.time()
+    for cs in clients.values():
+        for c in cs:
+            c.start()
+    for cs in clients.values():
+        for c in cs:
+            c.join()
+    elapsed = time.time() - st
+
+    result = {'clients': nclients, 'pipeline': pipeline, 'duration': elapsed, 'devices': {}}
+    total, total_errors = [], 0
+    for device, cs in clients.items():
+        lat = [l for c in cs for l in c.latencies]
+        errors = sum(c.errors for c in cs)
+        total.extend(lat)
+        total_errors += errors
+        result['devices'][device] = summarize(lat, errors, elapsed)
+    result['total'] = summarize(total, total_errors, elapsed)
+    return result
+
+
+def spawn_simulator(config=None):
+    """
+    start pychron_simulator.py on free ports
+
+    :return: process, dict of device name: port
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    ports_file = os.path.join(tempfile.mkdtemp(), 'ports.json')
+    args = [sys.executable, os.path.join(root, 'pychron_simulator.py'), '--ephemeral',
+            '--ports-file', ports_file]
+    if config:
+        args.extend(('--config', config))
+    process = subprocess.Popen(args, cwd=root)
+
+    def probe():
+        if process.poll() is not None:
+            raise OSError('simulator exited with {}'.format(process.returncode))
+        return os.path.isfile(ports_file)
+
+    if wait_for(probe, timeout=30) is None:
+        process.kill()
+        raise OSError('simulator did not start')
+
+    with open(ports_file, 'r') as rfile:
+        ports = json.load(rfile)
+
+    wait_for(lambda: all(probe_tcp('127.0.0.1', p) for p in ports.values()), timeout=10)
+    return process, ports
+
+
+def parse_ports(s):
+    """
+    "Valve=8000,Laser=8001" => {'Valve': 8000, 'Laser': 8001}
+    """
+    return dict((k.strip(), int(v)) for k, v in (kv.split('=') for kv in s.split(',')))
+
+
+def load_mix(path):
+    """
+    yaml mapping of device to {command: weight}
+    e.g.
+        Spectrometer:
+          GetData: 10
+          GetDAC: 1
+    """
+    with open(path, 'r') as rfile:
+        mix = yaml.safe_load(rfile)
+    return dict((device, sorted(cmds.items())) for device, cmds in mix.items())
+
+
+def main(args):
+    mixes = dict(DEFAULT_MIX)
+    if args.mix:
+        mixes.update(load_mix(args.mix))
+
+    process = None
+    if args.spawn:
+        process, ports = spawn_simulator(args.config)
+    elif args.ports_file:
+        with open(args.ports_file, 'r') as rfile:
+            ports = json.load(rfile)
+    else:
+        ports = parse_ports(args.ports)
+
+    if args.devices:
+        ports = dict((k, v) for k, v in ports.items() if k in args.devices.split(','))
+
+    try:
+        levels = [run_level(args.host, ports, mixes, int(n), args.duration, args.pipeline)
+                  for n in args.clients.split(',')]
+    finally:
+        if process:
+            process.kill()
+
+    report = {'timestamp': time.time(),
+              'host': args.host,
+              'ports': ports,
+              'mix': mixes,
+              'levels': levels}
+
+    out = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as wfile:
+            wfile.write(out)
+    else:
+        print out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure throughput and latency of the device simulators')
+    parser.add_argument('--host',
+                        type=str,
+                        default='127.0.0.1',
+                        help='simulator host')
+    parser.add_argument('--ports',
+                        type=str,
+                        default='Valve=8000,Laser=8001,Spectrometer=8002',
+                        help='device ports e.g. Valve=8000,Laser=8001')
+    parser.add_argument('--ports-file',
+                        type=str,
+                        default=None,
+                        help='json ports file written by pychron_simulator.py --ports-file')
+    parser.add_argument('--spawn',
+                        action='store_true',
+                        default=False,
+                        help='start a simulator on free ports for the benchmark')
+    parser.add_argument('--config',
+                        type=str,
+                        default=None,
+                        help='simulator yaml config, used with --spawn')
+    parser.add_argument('--devices',
+                        type=str,
+                        default=None,
+                        help='comma separated devices to load e.g. Valve,Laser')
+    parser.add_argument('--clients',
+                        type=str,
+                        default='1',
+                        help='concurrent connections per device. a comma separated list runs each level')
+    parser.add_argument('--duration',
+                        type=float,
+                        default=10,
+                        help='seconds per level')
+    parser.add_argument('--pipeline',
+                        type=int,
+                        default=1,
+                        help='commands written before reading the replies')
+    parser.add_argument('--mix',
+                        type=str,
+                        default=None,
+                        help='yaml file of command weights per device')
+    parser.add_argument('--output',
+                        type=str,
+                        default=None,
+                        help='write the json report here instead of stdout')
+
+    main(parser.parse_args())
+
+# ============= EOF =============================================
@@ -0,0 +1,216 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import json
+import logging
+import socket
+import time
+from Queue import LifoQueue, Empty, Full
+from threading import Lock
+# ============= local library imports  ==========================
+logger = logging.getLogger('psychodrama_control')
+logger.setLevel(logging.DEBUG)
+
+
+class ControlError(BaseException):
+    def __str__(self):
+        return 'ControlError {}'.format(self.args)
+
+
+def encode_frame(payload):
+    """
+    <decimal length>:<payload>. there is no upper bound on the length.
+    replaces the old two hex digit prefix, see ControlClient
+    """
+    return '{}:{}'.format(len(payload), payload)
+
+
+class _Connection(object):
+    def __init__(self, endpoint, timeout):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(endpoint)
+        self._buf = ''
+
+    def settimeout(self, timeout):
+        self._sock.settimeout(timeout)
+
+    def send(self, data):
+        self._sock.sendall(data)
+
+    def read_frame(self):
+        while ':' not in self._buf:
+            self._fill()
+            if len(self._buf) > 20 and ':' not in self._buf:
+                raise ControlError('bad frame header', self._buf[:20])
+
+        head, self._buf = self._buf.split(':', 1)
+        n = int(head)
+        while len(self._buf) < n:
+            self._fill()
+
+        payload, self._buf = self._buf[:n], self._buf[n:]
+        return payload
+
+    def close(self):
+        self._sock.close()
+
+    def _fill(self):
+        data = self._sock.recv(65536)
+        if not data:
+            raise ControlError('connection closed')
+        self._buf += data
+
+
+class ControlClient(object):
+    """
+    client for the psychodrama endpoint of the application under test.
+
+    requests are JSON objects with a ``command`` and an ``id``. requests and
+    replies are framed as ``<length>:<payload>`` and read in full. connections
+    are kept in a small pool and reused between commands, and ``pipeline``
+    writes several requests before reading any reply.
+
+    a reply that is a JSON object with an ``id`` is matched to its request,
+    anything else is taken as the reply to the oldest outstanding request
+
+    this is not the wire format the pychron psychodrama plugin spoke before.
+    it used to read requests framed as ``<two hex digit length><payload>`` on
+    a new connection per command and reply with an unframed string. the plugin
+    has to be changed to
+      - read ``<decimal length>:<payload>`` frames
+      - keep reading requests from a connection until the client closes it
+      - frame every reply the same way, in request order or as a JSON object
+        that carries the request's ``id``
+    """
+
+    def __init__(self, endpoint, timeout=30, pool_size=4):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self._pool = LifoQueue(maxsize=pool_size)
+        self._lock = Lock()
+        self._id = 0
+        self._stats = {}
+
+    def send(self, command, timeout=None, **kw):
+        return self.pipeline([(command, kw)], timeout=timeout)[0]
+
+    def pipeline(self, requests, timeout=None):
+        """
+        send all <requests> then collect their replies
+
+        :param requests: list of (command, kw) tuples
+        :param timeout: socket timeout for this call instead of the client's
+        :return: list of replies in the same order as <requests>
+        """
+        ids = []
+        frames = []
+        for command, kw in requests:
+            rid = self._next_id()
+            msg = dict(kw, command=command, id=rid)
+            ids.append((rid, command))
+            frames.append(encode_frame(json.dumps(msg)))
+
+        conn = self._checkout(self.timeout if timeout is None else timeout)
+        st = time.time()
+        try:
+            conn.send(''.join(frames))
+            replies = {}
+            pending = [rid for rid, _ in ids]
+            while pending:
+                rid, reply = self._parse(conn.read_frame(), pending[0])
+                replies[rid] = reply
+                if rid in pending:
+                    pending.remove(rid)
+                self._record(dict(ids).get(rid), time.time() - st)
+        except BaseException:
+            conn.close()
+            for _, command in ids:
+                self._record(command, None)
+            raise
+
+        self._checkin(conn)
+        return [replies.get(rid) for rid, _ in ids]
+
+    def stats(self):
+        """
+        latency statistics in seconds per command
+        """
+        with self._lock:
+            ret = {}
+            for k, v in self._stats.items():
+                n = v['count']
+                ret[k] = {'count': n,
+                          'errors': v['errors'],
+                          'mean': v['total'] / n if n else 0,
+                          'min': v['min'],
+                          'max': v['max']}
+            return ret
+
+    def close(self):
+        while 1:
+            try:
+                self._pool.get_nowait().close()
+            except Empty:
+                break
+
+    # private
+    def _parse(self, payload, default_id):
+        try:
+            obj = json.loads(payload)
+        except ValueError:
+            return default_id, payload
+
+        if isinstance(obj, dict) and 'id' in obj:
+            return obj['id'], obj.get('response')
+        return default_id, obj
+
+    def _next_id(self):
+        with self._lock:
+            self._id += 1
+            return self._id
+
+    def _record(self, command, dt):
+        with self._lock:
+            s = self._stats.setdefault(command, {'count': 0, 'errors': 0, 'total': 0,
+                                                 'min': None, 'max': None})
+            if dt is None:
+                s['errors'] += 1
+                return
+
+            s['count'] += 1
+            s['total'] += dt
+            s['min'] = dt if s['min'] is None else min(s['min'], dt)
+            s['max'] = dt if s['max'] is None else max(s['max'], dt)
+
+    def _checkout(self, timeout):
+        try:
+            conn = self._pool.get_nowait()
+            conn.settimeout(timeout)
+            return conn
+        except Empty:
+            logger.debug('connect to {}'.format(self.endpoint))
+            return _Connection(self.endpoint, timeout)
+
+    def _checkin(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except Full:
+            conn.close()
+
+# ============= EOF =============================================
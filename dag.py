@@ -0,0 +1,204 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import sys
+import time
+from Queue import Queue
+from threading import Thread
+# ============= local library imports  ==========================
+
+
+class StepGraphError(BaseException):
+    def __str__(self):
+        return 'StepGraphError {}'.format(self.args)
+
+
+class StepNode(object):
+    def __init__(self, name, step, needs):
+        self.name = name
+        self.step = step
+        self.needs = needs
+
+    def __repr__(self):
+        return 'StepNode({}, {}, needs={})'.format(self.name, self.step, self.needs)
+
+
+def build_graph(steps):
+    """
+    turn the list of steps of a phase into a list of StepNodes.
+
+    a step is one of
+      - a string, e.g. ``start_sim:PychronSimulator``. runs after the previous step
+      - ``{parallel: [step, ...]}``. the members run concurrently after the previous
+        step. the next step waits for all of them
+      - ``{step: <string>, name: <name>, needs: [<name>, ...]}``. runs after the named
+        steps, or after the previous step if ``needs`` is omitted
+
+    e.g.
+        run:
+          - start_sim:PychronSimulator
+          - parallel:
+              - name: valve
+                step: test_simulator:Valve
+              - name: laser
+                step: test_simulator:Laser
+          - name: experiment
+            step: execute_experiment:experiment1
+            needs: [valve, laser]
+
+    only steps that are really independent should run in parallel. start_sim
+    starts a whole simulator set on each call, so parallel start_sim steps start
+    several sets and the last one wins the ports
+
+    :return: list of StepNodes in definition order
+    """
+    nodes = []
+    previous = []
+
+    def make(item, idx, default_needs):
+        if isinstance(item, basestring):
+            return StepNode('{}:{}'.format(idx, item), item, list(default_needs))
+        elif isinstance(item, dict) and 'step' in item:
+            name = str(item.get('name', '{}:{}'.format(idx, item['step'])))
+            needs = item.get('needs')
+            needs = list(default_needs) if needs is None else [str(n) for n in needs]
+            return StepNode(name, item['step'], needs)
+        raise StepGraphError('invalid step', item)
+
+    for i, item in enumerate(steps):
+        if isinstance(item, dict) and 'parallel' in item:
+            group = [make(gi, '{}.{}'.format(i, j), previous) for j, gi in enumerate(item['parallel'])]
+            nodes.extend(group)
+            previous = [n.name for n in group]
+        else:
+            node = make(item, i, previous)
+            nodes.append(node)
+            previous = [node.name]
+
+    _validate(nodes)
+    return nodes
+
+
+def _validate(nodes):
+    names = [n.name for n in nodes]
+    if len(set(names)) != len(names):
+        raise StepGraphError('duplicate step names', names)
+
+    for n in nodes:
+        for d in n.needs:
+            if d not in names:
+                raise StepGraphError('unknown dependency', n.name, d)
+
+    # kahn's algorithm. anything left over is part of a cycle
+    indegree = dict((n.name, len(n.needs)) for n in nodes)
+    ready = [n.name for n in nodes if not n.needs]
+    seen = 0
+    while ready:
+        name = ready.pop()
+        seen += 1
+        for n in nodes:
+            if name in n.needs:
+                indegree[n.name] -= 1
+                if not indegree[n.name]:
+                    ready.append(n.name)
+
+    if seen != len(nodes):
+        raise StepGraphError('dependency cycle', [k for k, v in indegree.items() if v])
+
+
+def execute(nodes, func, workers=4):
+    """
+    run ``func(node.step)`` for every node on a pool of <workers> threads. a node
+    starts as soon as everything it needs has finished.
+
+    fail fast. after the first failure no new steps are started, the steps that
+    are already running are allowed to finish and the first exception is re-raised.
+    the timings of the steps that did run, the failed one included, are attached
+    to it as ``step_timings``
+
+    :return: list of (name, step, start, duration) in the order the steps finished
+    """
+    dependents = dict((n.name, []) for n in nodes)
+    waiting = {}
+    for n in nodes:
+        waiting[n.name] = len(n.needs)
+        for d in n.needs:
+            dependents[d].append(n)
+
+    todo = Queue()
+    done = Queue()
+
+    def work():
+        while 1:
+            node = todo.get()
+            if node is None:
+                break
+
+            st = time.time()
+            try:
+                func(node.step)
+                exc_info = None
+            except BaseException:
+                exc_info = sys.exc_info()
+            done.put((node, st, time.time() - st, exc_info))
+
+    threads = []
+    for i in range(max(1, min(workers, len(nodes)))):
+        t = Thread(target=work, name='step-{}'.format(i))
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+
+    timings = []
+    failure = None
+    running = 0
+    try:
+        for n in nodes:
+            if not n.needs:
+                todo.put(n)
+                running += 1
+
+        while running:
+            node, st, dur, exc_info = done.get()
+            running -= 1
+            timings.append((node.name, node.step, st, dur))
+            if exc_info:
+                if failure is None:
+                    failure = exc_info
+                continue
+
+            if failure is None:
+                for child in dependents[node.name]:
+                    waiting[child.name] -= 1
+                    if not waiting[child.name]:
+                        todo.put(child)
+                        running += 1
+    finally:
+        for _ in threads:
+            todo.put(None)
+
+    if failure:
+        try:
+            failure[1].step_timings = timings
+        except AttributeError:
+            pass
+        raise failure[0], failure[1], failure[2]
+
+    return timings
+
+# ============= EOF =============================================
@@ -0,0 +1,136 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+# ============= local library imports  ==========================
+from fileutil import open_lock
+
+logger = logging.getLogger('psychodrama_dbtemplate')
+logger.setLevel(logging.DEBUG)
+
+
+def sql_key(sql):
+    """
+    content address of a ``database: sql`` list
+    """
+    return hashlib.sha1(json.dumps(sql)).hexdigest()[:16]
+
+
+class DatabaseTemplates(object):
+    """
+    cache of built sqlite databases keyed by their sql.
+
+    a template is built once, by running all of the sql as one script in one
+    transaction, and every run starts from a copy of it. building holds an
+    exclusive lock on the template, copying a shared one. only the <keep> most
+    recently used templates are kept
+    """
+
+    def __init__(self, root=None, keep=20):
+        if root is None:
+            root = os.path.join(os.path.expanduser('~'), '.psychodrama', 'dbtemplates')
+        self.root = root
+        self.keep = keep
+
+    def create(self, path, sql):
+        """
+        create the database <path> from <sql>, a list of sql strings
+
+        :return: True if the template was already built
+        """
+        key = sql_key(sql)
+        template = os.path.join(self.root, '{}.sqlite3'.format(key))
+        fd = self._open_lock(key)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            hit = os.path.isfile(template)
+            if hit:
+                logger.debug('template hit {}'.format(key))
+                os.utime(template, None)
+            else:
+                self._build(template, sql)
+
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            self._copy(template, path)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+        if not hit:
+            self.prune()
+        return hit
+
+    def prune(self):
+        templates = [os.path.join(self.root, p) for p in os.listdir(self.root) if p.endswith('.sqlite3')]
+        templates.sort(key=os.path.getmtime, reverse=True)
+        for p in templates[self.keep:]:
+            key = os.path.basename(p).split('.')[0]
+            fd = self._open_lock(key)
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    continue
+                logger.info('evict template {}'.format(key))
+                os.remove(p)
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+
+    # private
+    def _build(self, template, sql):
+        logger.info('build template {}'.format(os.path.basename(template)))
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.root)
+        os.close(fd)
+        try:
+            conn = sqlite3.connect(tmp)
+            try:
+                script = ';\n'.join(s.strip().rstrip(';') for s in sql)
+                conn.executescript('BEGIN;\n{};\nCOMMIT;'.format(script))
+            finally:
+                conn.close()
+            os.rename(tmp, template)
+        except BaseException:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            raise
+
+    def _copy(self, template, path):
+        for ext in ('', '-journal', '-wal', '-shm'):
+            p = '{}{}'.format(path, ext)
+            if os.path.isfile(p):
+                os.remove(p)
+
+        tmp = '{}.tmp'.format(path)
+        shutil.copyfile(template, tmp)
+        os.rename(tmp, path)
+
+    def _open_lock(self, key):
+        return open_lock(os.path.join(self.root, '{}.lock'.format(key)))
+
+
+db_templates = DatabaseTemplates()
+
+# ============= EOF =============================================
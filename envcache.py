@@ -0,0 +1,248 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from threading import Lock
+# ============= local library imports  ==========================
+from fileutil import open_lock
+
+logger = logging.getLogger('psychodrama_envcache')
+logger.setLevel(logging.DEBUG)
+
+MARKER = '.psychodrama_env'
+GB = 1024 ** 3
+
+
+def env_key(env):
+    """
+    content address of an ``environment`` block. only the name, dependencies and pip
+    list contribute so reordering the yaml or adding comments does not bust the cache
+    """
+    spec = {'name': env['name'],
+            'dependencies': sorted(env.get('dependencies') or []),
+            'pip': sorted(env.get('pip') or [])}
+    return hashlib.sha1(json.dumps(spec, sort_keys=True)).hexdigest()
+
+
+def dir_size(root):
+    """
+    disk usage of <root>. hard links into the conda package cache are only counted once
+    """
+    seen = set()
+    total = 0
+    for r, ds, fs in os.walk(root):
+        for f in fs:
+            try:
+                st = os.lstat(os.path.join(r, f))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_size
+    return total
+
+
+class EnvLease(object):
+    """
+    a cached environment held by a run. the environment cannot be evicted or rebuilt
+    until the lease is released
+    """
+
+    def __init__(self, key, name, path, fd, hit):
+        self.key = key
+        self.name = name
+        self.path = path
+        self.hit = hit
+        self._fd = fd
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+class EnvironmentCache(object):
+    """
+    conda environments keyed by a hash of the ``environment`` block of .psycho.yaml.
+
+    a cache hit hands back an existing environment without calling the conda solver.
+    each cached environment has a lock file that runs hold shared while they use it.
+    eviction needs it exclusively so it never removes an environment that is in use.
+    builds are serialized by a second lock file so concurrent runs, in this or
+    another process, never use a half built environment.
+
+    when the total size exceeds <budget> bytes the least recently used environments
+    are removed
+    """
+    grace = 60
+
+    def __init__(self, root=None, budget=20 * GB):
+        if root is None:
+            root = os.path.join(os.path.expanduser('~'), '.psychodrama', 'envcache')
+        self.root = root
+        self.budget = budget
+        self._index_lock = Lock()
+
+    def acquire(self, conda_root, env, builder):
+        """
+        return an EnvLease for <env>. <builder> is called with the environment name
+        if there is no usable cached environment
+
+        :param conda_root: path to the conda installation
+        :param env: ``environment`` block of .psycho.yaml
+        :param builder: callable(name)
+        :return: EnvLease
+        """
+        key = env_key(env)
+        name = 'pd_{}'.format(key[:16])
+        path = os.path.join(conda_root, 'envs', name)
+
+        fd = self._open_lock(key)
+        try:
+            # a shared lock pins the environment for the whole run. it is never
+            # taken exclusively while waiting for a build so a run never waits
+            # on another run using the environment
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            hit = os.path.isfile(os.path.join(path, MARKER))
+            if not hit:
+                # builds are serialized by a separate lock. someone else may
+                # have built it while we waited so check again
+                bfd = self._open_lock('{}.build'.format(key))
+                try:
+                    fcntl.flock(bfd, fcntl.LOCK_EX)
+                    hit = os.path.isfile(os.path.join(path, MARKER))
+                    if not hit:
+                        logger.info('cache miss {} for {}'.format(name, env['name']))
+                        if os.path.isdir(path):
+                            # left over from a failed build
+                            shutil.rmtree(path)
+
+                        st = time.time()
+                        builder(name)
+                        with open(os.path.join(path, MARKER), 'w') as wfile:
+                            wfile.write(key)
+                        logger.info('built {} in {:0.1f}s'.format(name, time.time() - st))
+                        self._touch(key, name, dir_size(path))
+                finally:
+                    fcntl.flock(bfd, fcntl.LOCK_UN)
+                    os.close(bfd)
+
+            if hit:
+                logger.info('cache hit {} for {}'.format(name, env['name']))
+                self._touch(key, name)
+        except BaseException:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+            raise
+
+        self.evict(conda_root)
+        return EnvLease(key, name, path, fd, hit)
+
+    def evict(self, conda_root):
+        """
+        remove least recently used environments until the cache fits the budget.
+        environments that are locked or were used in the last <grace> seconds are skipped
+        """
+        with self._locked_index():
+            index = self._load_index()
+            total = sum(v['size'] for v in index.values())
+            if total <= self.budget:
+                return
+
+            now = time.time()
+            for key, v in sorted(index.items(), key=lambda kv: kv[1]['last_used']):
+                if total <= self.budget:
+                    break
+                if now - v['last_used'] < self.grace:
+                    continue
+
+                fd = self._open_lock(key)
+                try:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except IOError:
+                        continue
+
+                    path = os.path.join(conda_root, 'envs', v['name'])
+                    logger.info('evict {} ({:0.2f} GB)'.format(v['name'], v['size'] / float(GB)))
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    total -= v['size']
+                    del index[key]
+                finally:
+                    os.close(fd)
+
+            self._dump_index(index)
+
+    # private
+    @contextmanager
+    def _locked_index(self):
+        with self._index_lock:
+            fd = self._open_lock('index')
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+    def _open_lock(self, key):
+        return open_lock(os.path.join(self.root, '{}.lock'.format(key)))
+
+    def _touch(self, key, name, size=None):
+        with self._locked_index():
+            index = self._load_index()
+            entry = index.setdefault(key, {'name': name, 'size': 0})
+            if size is not None:
+                entry['size'] = size
+            entry['last_used'] = time.time()
+            self._dump_index(index)
+
+    def _index_path(self):
+        return os.path.join(self.root, 'index.json')
+
+    def _load_index(self):
+        p = self._index_path()
+        if os.path.isfile(p):
+            with open(p, 'r') as rfile:
+                try:
+                    return json.load(rfile)
+                except ValueError:
+                    logger.warning('corrupt env cache index. starting fresh')
+        return {}
+
+    def _dump_index(self, index):
+        p = self._index_path()
+        tmp = '{}.tmp{}'.format(p, os.getpid())
+        with open(tmp, 'w') as wfile:
+            json.dump(index, wfile, indent=2)
+        os.rename(tmp, p)
+
+
+env_cache = EnvironmentCache()
+
+# ============= EOF =============================================
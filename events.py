@@ -0,0 +1,115 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import json
+import logging
+import time
+from Queue import Queue, Full
+from collections import deque
+from threading import Lock
+# ============= local library imports  ==========================
+logger = logging.getLogger('psychodrama_events')
+logger.setLevel(logging.DEBUG)
+
+
+class Subscription(object):
+    def __init__(self, maxsize):
+        self.queue = Queue(maxsize=maxsize)
+        self.overflowed = False
+
+
+class EventBus(object):
+    """
+    publish/subscribe for live job progress.
+
+    ``publish`` never blocks. every subscriber has its own bounded queue, a
+    subscriber that falls <queue_size> events behind is marked overflowed and
+    stops receiving events. the last <history> events are kept so a client that
+    reconnects can catch up from the last event id it saw
+    """
+
+    def __init__(self, queue_size=1000, history=500):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._history = deque(maxlen=history)
+        self._lock = Lock()
+        self._id = 0
+
+    def publish(self, kind, **data):
+        with self._lock:
+            self._id += 1
+            event = {'id': self._id, 'kind': kind, 'time': time.time(), 'data': data}
+            self._history.append(event)
+            for sub in self._subscribers:
+                if sub.overflowed:
+                    continue
+                try:
+                    sub.queue.put_nowait(event)
+                except Full:
+                    sub.overflowed = True
+        return event
+
+    def subscribe(self, last_id=None):
+        """
+        :param last_id: replay the events after this id
+        :return: Subscription
+        """
+        sub = Subscription(self.queue_size)
+        with self._lock:
+            if last_id is not None:
+                for event in self._history:
+                    if event['id'] > last_id:
+                        sub.queue.put_nowait(event)
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+
+def format_sse(event):
+    """
+    one event in text/event-stream format
+    """
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(event['id'], event['kind'], json.dumps(event['data']))
+
+
+class EventLogHandler(logging.Handler):
+    """
+    publishes records tagged with a job id as "log" events
+    """
+
+    def __init__(self, bus, level=logging.INFO):
+        logging.Handler.__init__(self, level)
+        self.bus = bus
+
+    def emit(self, record):
+        job_id = getattr(record, 'job_id', None)
+        if job_id:
+            self.bus.publish('log', job_id=job_id, level=record.levelname, logger=record.name,
+                             msg=record.getMessage())
+
+
+event_bus = EventBus()
+
+# ============= EOF =============================================
@@ -0,0 +1,46 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import os
+# ============= local library imports  ==========================
+
+
+def makedirs(path):
+    """
+    make <path> and its parents. safe when another thread or process makes it
+    at the same time
+    """
+    if path and not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # made by someone else in the meantime
+            if not os.path.isdir(path):
+                raise
+
+
+def open_lock(path):
+    """
+    open, creating if necessary, the lock file <path> for use with fcntl.flock
+
+    :return: file descriptor. the caller closes it
+    """
+    makedirs(os.path.dirname(path))
+    return os.open(path, os.O_RDWR | os.O_CREAT)
+
+# ============= EOF =============================================
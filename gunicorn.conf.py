@@ -0,0 +1,34 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+# ============= local library imports  ==========================
+# gunicorn -c gunicorn.conf.py wsgi:app
+
+bind = '0.0.0.0:8000'
+
+# one process. the run scheduler, result writer, event bus and simulator host
+# live in the app process and must not be duplicated
+workers = 1
+
+# /events keeps a request open per results page. sync workers would be held
+# by it and stop accepting webhooks, so serve requests on threads. gthread
+# needs the futures backport on python 2
+worker_class = 'gthread'
+threads = 32
+
+# ============= EOF =============================================
@@ -0,0 +1,261 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import json
+import logging
+import os
+import sys
+from Queue import Queue, Full
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from threading import Thread, local
+# ============= local library imports  ==========================
+from fileutil import makedirs
+
+NAME_WIDTH = 40
+gFORMAT = '%(name)-{}s: %(asctime)s %(levelname)-9s (%(threadName)-10s) [%(job_id)s] %(message)s'.format(NAME_WIDTH)
+MB = 1024 ** 2
+
+_context = local()
+
+
+@contextmanager
+def job_context(job_id):
+    """
+    tag every record logged by the calling thread with <job_id>
+    """
+    previous = getattr(_context, 'job_id', None)
+    _context.job_id = job_id
+    try:
+        yield
+    finally:
+        _context.job_id = previous
+
+
+class JobFilter(logging.Filter):
+    """
+    sets record.job_id from the thread's job_context unless the caller passed
+    one with extra={'job_id': ...}
+    """
+
+    def filter(self, record):
+        if getattr(record, 'job_id', None) is None:
+            record.job_id = getattr(_context, 'job_id', None)
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        d = {'time': self.formatTime(record),
+             'created': record.created,
+             'level': record.levelname,
+             'logger': record.name,
+             'thread': record.threadName,
+             'job_id': getattr(record, 'job_id', None),
+             'msg': record.getMessage()}
+        if record.exc_text:
+            d['exc'] = record.exc_text
+        return json.dumps(d)
+
+
+class QueueHandler(logging.Handler):
+    """
+    hands records to a LogListener. emit never blocks, if the queue is full the
+    record is dropped and counted
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            # format the message and traceback now. args and exc_info may not
+            # survive until the listener gets to the record
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+        except BaseException:
+            self.handleError(record)
+
+
+class JobFileHandler(logging.Handler):
+    """
+    writes records tagged with a job id to <root>/<job_id>.log. each file
+    rotates at <max_bytes>. at most <max_open> files are kept open and only the
+    <keep> most recent job logs are kept on disk
+    """
+
+    def __init__(self, root, max_bytes=10 * MB, backups=2, max_open=16, keep=500):
+        logging.Handler.__init__(self)
+        self.root = root
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.max_open = max_open
+        self.keep = keep
+        self._handlers = OrderedDict()
+        makedirs(root)
+
+    def emit(self, record):
+        job_id = getattr(record, 'job_id', None)
+        if job_id:
+            self._handler(job_id).handle(record)
+
+    def close_job(self, job_id):
+        h = self._handlers.pop(job_id, None)
+        if h:
+            h.close()
+        self._prune()
+
+    def close(self):
+        for h in self._handlers.values():
+            h.close()
+        self._handlers.clear()
+        logging.Handler.close(self)
+
+    # private
+    def _handler(self, job_id):
+        h = self._handlers.pop(job_id, None)
+        if h is None:
+            h = RotatingFileHandler(os.path.join(self.root, '{}.log'.format(job_id)),
+                                    maxBytes=self.max_bytes, backupCount=self.backups)
+            h.setFormatter(self.formatter)
+            while len(self._handlers) >= self.max_open:
+                self._handlers.popitem(last=False)[1].close()
+        self._handlers[job_id] = h
+        return h
+
+    def _prune(self):
+        logs = [os.path.join(self.root, p) for p in os.listdir(self.root) if p.endswith('.log')]
+        if len(logs) > self.keep:
+            logs.sort(key=os.path.getmtime, reverse=True)
+            for p in logs[self.keep:]:
+                for pi in [p] + ['{}.{}'.format(p, i) for i in range(1, self.backups + 1)]:
+                    if os.path.isfile(pi):
+                        os.remove(pi)
+
+
+class LogListener(object):
+    """
+    the only thread that writes log files. takes records off <queue> and passes
+    them to <handlers>
+    """
+
+    def __init__(self, queue, handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='log-listener')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def close_job(self, job_id):
+        """
+        close the job's log file once everything it logged has been written
+        """
+        try:
+            self.queue.put_nowait(('close_job', job_id))
+        except Full:
+            # the file is closed once it is the least recently used
+            pass
+
+    def stop(self):
+        self.queue.put(None)
+        self._thread.join()
+
+    # private
+    def _run(self):
+        while 1:
+            record = self.queue.get()
+            if record is None:
+                break
+
+            if isinstance(record, tuple):
+                for h in self.handlers:
+                    if isinstance(h, JobFileHandler):
+                        h.close_job(record[1])
+                continue
+
+            for h in self.handlers:
+                if record.levelno >= h.level:
+                    try:
+                        h.handle(record)
+                    except BaseException:
+                        h.handleError(record)
+
+        for h in self.handlers:
+            h.close()
+
+
+_listener = None
+
+
+def setup_logging(root='logs', level=logging.DEBUG, max_bytes=50 * MB, backups=5, queue_size=100000,
+                  handlers=None):
+    """
+    route all logging through a queue to a listener thread which writes
+      - text to stderr
+      - json to <root>/psychodrama.log, appended to and rotated at <max_bytes>
+      - json to <root>/jobs/<job_id>.log for records tagged with a job id
+      - to any extra <handlers>
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    makedirs(root)
+
+    shandler = logging.StreamHandler(sys.stderr)
+    shandler.setFormatter(logging.Formatter(gFORMAT))
+
+    fhandler = RotatingFileHandler(os.path.join(root, 'psychodrama.log'), mode='a',
+                                   maxBytes=max_bytes, backupCount=backups)
+    fhandler.setFormatter(JSONFormatter())
+
+    jhandler = JobFileHandler(os.path.join(root, 'jobs'))
+    jhandler.setFormatter(JSONFormatter())
+
+    queue = Queue(maxsize=queue_size)
+    qhandler = QueueHandler(queue)
+    qhandler.addFilter(JobFilter())
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    for h in root_logger.handlers[:]:
+        root_logger.removeHandler(h)
+    root_logger.addHandler(qhandler)
+
+    _listener = LogListener(queue, [shandler, fhandler, jhandler] + list(handlers or []))
+    _listener.start()
+    return _listener
+
+
+def close_job_log(job_id):
+    if _listener is not None:
+        _listener.close_job(job_id)
+
+# ============= EOF =============================================
@@ -0,0 +1,162 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import fcntl
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+from threading import Lock
+
+from git import Repo, GitCommandError
+# ============= local library imports  ==========================
+from fileutil import open_lock
+
+logger = logging.getLogger('psychodrama_mirror')
+logger.setLevel(logging.DEBUG)
+
+_locks = {}
+_locks_lock = Lock()
+
+
+def _thread_lock(key):
+    with _locks_lock:
+        return _locks.setdefault(key, Lock())
+
+
+class RepoMirror(object):
+    """
+    one bare mirror per repository plus a cheap ``git worktree`` per run.
+
+    the mirror only fetches the commit that is going to be tested, so after the
+    first fetch each run transfers just the new objects. runs get their own
+    detached worktree so any number of branches can build at the same time
+    """
+
+    def __init__(self, name, url, root=None):
+        if root is None:
+            root = os.path.join(os.path.expanduser('~'), '.psychodrama')
+
+        self.name = name
+        self.url = url
+        self.path = os.path.join(root, 'mirrors', '{}.git'.format(name))
+        self.worktree_root = os.path.join(root, 'worktrees', name)
+        self._repo = None
+
+    def fetch(self, branch, sha=None, depth=10):
+        """
+        fetch <sha> into the mirror. if the server does not allow fetching a
+        commit by id fall back to fetching <branch>
+
+        :param branch: name of the branch that was pushed
+        :param sha: checkout_sha from the webhook payload
+        :param depth: history depth fetched with each new commit
+        :return: sha of the fetched commit
+        """
+        with self._locked():
+            repo = self._get_repo()
+            # always narrow. a commit whose history does not reach what is
+            # already in the mirror would otherwise pull the full history
+            kw = {'no_tags': True, 'depth': depth}
+
+            if sha and self._has_commit(repo, sha):
+                logger.debug('{} already in mirror {}'.format(sha, self.name))
+            else:
+                fetched = False
+                if sha:
+                    logger.debug('fetch {} from {}'.format(sha, self.url))
+                    try:
+                        repo.git.fetch('origin', sha, **kw)
+                        fetched = True
+                    except GitCommandError, e:
+                        logger.debug('fetch by sha refused. {}'.format(e))
+
+                if not fetched:
+                    logger.debug('fetch branch {} from {}'.format(branch, self.url))
+                    repo.git.fetch('origin', 'refs/heads/{}'.format(branch), **kw)
+
+                if not sha:
+                    sha = repo.git.rev_parse('FETCH_HEAD')
+
+            # keep the tested commit reachable so gc does not prune it
+            repo.git.update_ref('refs/heads/{}'.format(branch), sha)
+            return sha
+
+    def add_worktree(self, sha, tag):
+        """
+        check out <sha> into a new detached worktree
+
+        :return: path to the worktree
+        """
+        path = os.path.join(self.worktree_root, str(tag))
+        with self._locked():
+            repo = self._get_repo()
+            if os.path.isdir(path):
+                self._remove_worktree(repo, path)
+
+            logger.debug('add worktree {} at {}'.format(path, sha))
+            repo.git.worktree('add', '--detach', path, sha)
+        return path
+
+    def remove_worktree(self, path):
+        with self._locked():
+            self._remove_worktree(self._get_repo(), path)
+
+    # private
+    def _remove_worktree(self, repo, path):
+        logger.debug('remove worktree {}'.format(path))
+        try:
+            repo.git.worktree('remove', '--force', path)
+        except GitCommandError:
+            # older git. remove the directory and let prune clean up the metadata
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            repo.git.worktree('prune')
+
+    def _has_commit(self, repo, sha):
+        try:
+            repo.git.cat_file('-e', '{}^{{commit}}'.format(sha))
+            return True
+        except GitCommandError:
+            pass
+
+    def _get_repo(self):
+        if self._repo is None:
+            if os.path.isdir(self.path):
+                self._repo = Repo(self.path)
+            else:
+                logger.info('create mirror {} for {}'.format(self.path, self.url))
+                self._repo = Repo.init(self.path, bare=True, mkdir=True)
+                self._repo.create_remote('origin', self.url)
+        return self._repo
+
+    @contextmanager
+    def _locked(self):
+        """
+        serialize git operations on the mirror between threads and processes
+        """
+        with _thread_lock(self.path):
+            fd = open_lock('{}.lock'.format(self.path))
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+# ============= EOF =============================================
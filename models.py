@@ -17,27 +17,166 @@
 # ============= enthought library imports =======================
 # ============= standard library imports ========================
 # ============= local library imports  ==========================
+import json
+from datetime import datetime
+
 from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import or_, and_
 
 from psychodrama import app
 
 db = SQLAlchemy(app)
 
+CURSOR_FMT = '%Y%m%d%H%M%S%f'
+
 
 def create_db():
     db.create_all()
+    migrate_db()
+
+
+def migrate_db():
+    """
+    bring tables created by an older psychodrama up to date. create_all skips
+    tables that already exist so add the missing columns and indexes here
+    """
+    for table in (ResultTbl.__table__, TimingSpanTbl.__table__):
+        existing = [r[1] for r in db.engine.execute('PRAGMA table_info({})'.format(table.name))]
+        for c in table.columns:
+            if c.name not in existing:
+                db.engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table.name, c.name,
+                                                                       c.type.compile(db.engine.dialect)))
+
+        for idx in table.indexes:
+            db.engine.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(idx.name, table.name,
+                                                                              ', '.join(c.name for c in idx.columns)))
+
+    # keyset pagination compares pub_date as text so it has to be stored in
+    # one format. str(datetime) drops the microseconds when they are zero
+    db.engine.execute("UPDATE {} SET pub_date = pub_date || '.000000' "
+                      "WHERE length(pub_date) = 19".format(ResultTbl.__tablename__))
+
+
+def encode_cursor(result):
+    return '{}_{}'.format(result.pub_date.strftime(CURSOR_FMT), result.id)
+
+
+def decode_cursor(cursor):
+    """
+    :raise ValueError: if <cursor> is not one made by encode_cursor
+    """
+    date, rid = cursor.split('_')
+    return datetime.strptime(date, CURSOR_FMT), int(rid)
+
+
+def query_results(branch=None, status=None, before=None, limit=50):
+    """
+    one page of results, newest first.
+
+    uses keyset pagination on (pub_date, id) so a page costs the same no matter
+    how far back it is. pass the returned cursor as <before> to get the next page
+
+    :return: results, cursor for the next page or None
+    """
+    q = ResultTbl.query
+    if branch:
+        q = q.filter(ResultTbl.branch == branch)
+    if status:
+        q = q.filter(ResultTbl.status == status)
+    if before:
+        date, rid = decode_cursor(before)
+        q = q.filter(or_(ResultTbl.pub_date < date,
+                         and_(ResultTbl.pub_date == date, ResultTbl.id < rid)))
+
+    rs = q.order_by(ResultTbl.pub_date.desc(), ResultTbl.id.desc()).limit(limit + 1).all()
+    cursor = None
+    if len(rs) > limit:
+        rs = rs[:limit]
+        cursor = encode_cursor(rs[-1])
+    return rs, cursor
+
+
+def query_spans(result_ids):
+    """
+    timing spans of several results in one query
+
+    :return: dict of result id: list of spans ordered by start
+    """
+    spans = {}
+    if result_ids:
+        q = TimingSpanTbl.query.filter(TimingSpanTbl.result_id.in_(result_ids))
+        for si in q.order_by(TimingSpanTbl.result_id, TimingSpanTbl.start):
+            spans.setdefault(si.result_id, []).append(si)
+    return spans
 
 
 class ResultTbl(db.Model):
     __tablename__ = 'ResultTbl'
+    __table_args__ = (db.Index('ix_ResultTbl_pub_date_id', 'pub_date', 'id'),
+                      db.Index('ix_ResultTbl_status_pub_date', 'status', 'pub_date'),
+                      db.Index('ix_ResultTbl_branch_pub_date', 'branch', 'pub_date'),
+                      {'sqlite_autoincrement': True})
+
     id = db.Column(db.Integer, primary_key=True)
     msg = db.Column(db.BLOB)
     pub_date = db.Column(db.DateTime)
     status = db.Column(db.String(80))
     duration = db.Column(db.FLOAT)
+    branch = db.Column(db.String(140))
+    sha = db.Column(db.String(40))
+    commits = db.Column(db.Text)
 
     @property
     def fduration(self):
         return '{:0.1f}'.format(self.duration)
 
+    @property
+    def fmsg(self):
+        # msg is stored as bytes, it can hold anything an exception said
+        return str(self.msg).decode('utf-8', 'replace') if self.msg is not None else None
+
+    @property
+    def commit_list(self):
+        return json.loads(self.commits) if self.commits else []
+
+    def to_dict(self):
+        return {'id': self.id,
+                'date': self.pub_date.isoformat() if self.pub_date else None,
+                'msg': self.fmsg,
+                'status': self.status,
+                'duration': self.duration,
+                'branch': self.branch,
+                'sha': self.sha,
+                'commits': self.commit_list}
+
+
+class TimingSpanTbl(db.Model):
+    """
+    how long one phase (pull, setup_env, run, ...) or step of a run took, a
+    pip package took to build and install (kind pip) or an app or simulator
+    took to become ready (kind ready). <start> is in seconds
+    since the start of the run. a step's <parent> is the phase it ran in, a pip
+    span's the pip command. <regressed> is set if it was slower than the baseline
+    """
+    __tablename__ = 'TimingSpanTbl'
+    __table_args__ = (db.Index('ix_TimingSpanTbl_result_id', 'result_id'),
+                      {'sqlite_autoincrement': True})
+
+    id = db.Column(db.Integer, primary_key=True)
+    result_id = db.Column(db.Integer, db.ForeignKey('ResultTbl.id'))
+    kind = db.Column(db.String(20))
+    name = db.Column(db.String(140))
+    parent = db.Column(db.String(40))
+    start = db.Column(db.FLOAT)
+    duration = db.Column(db.FLOAT)
+    regressed = db.Column(db.Boolean, default=False)
+
+    def to_dict(self):
+        return {'kind': self.kind,
+                'name': self.name,
+                'parent': self.parent,
+                'start': self.start,
+                'duration': self.duration,
+                'regressed': bool(self.regressed)}
+
 # ============= EOF =============================================
@@ -0,0 +1,190 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import hashlib
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+import yaml
+# ============= local library imports  ==========================
+from dag import build_graph, StepGraphError
+
+logger = logging.getLogger('psychodrama_plan')
+logger.setLevel(logging.DEBUG)
+
+PHASES = ('pre_run', 'run', 'post_run')
+
+# the C loader is an order of magnitude faster when libyaml is available
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+NUMBER = (int, long, float)
+
+# key: (type, required)
+SCHEMA = {'endpoint': (basestring, True),
+          'environment': (dict, True),
+          'control_timeout': (NUMBER, False),
+          'ready_timeout': (NUMBER, False),
+          'max_parallel': (int, False),
+          'simulator': (basestring, False),
+          'simulator_config': (dict, False),
+          'database': (dict, False),
+          'support': (list, False),
+          'isolate_support': (bool, False),
+          'pre_run': (list, False),
+          'run': (list, False),
+          'post_run': (list, False)}
+
+
+class PlanError(BaseException):
+    def __str__(self):
+        return 'PlanError {}'.format(self.args)
+
+
+def blob_sha(text):
+    """
+    the sha git gives <text> as a blob. the same as ``git hash-object``
+    """
+    return hashlib.sha1('blob {}\0{}'.format(len(text), text)).hexdigest()
+
+
+class RunPlan(object):
+    """
+    a validated .psycho.yaml. ``graphs`` holds the step graph of every phase.
+    a plan is shared by every run of the same .psycho.yaml so it must not be
+    modified
+    """
+
+    def __init__(self, sha, config, graphs):
+        self.sha = sha
+        self.config = config
+        self.graphs = graphs
+
+
+def compile_plan(text, actions, sha=None):
+    """
+    parse and validate a .psycho.yaml
+
+    :param actions: names of the steps a runner can execute e.g. start_app
+    :return: RunPlan
+    """
+    try:
+        config = yaml.load(text, Loader=Loader)
+    except yaml.YAMLError, e:
+        raise PlanError('invalid yaml', str(e))
+
+    if not isinstance(config, dict):
+        raise PlanError('.psycho.yaml must be a mapping')
+
+    for key, (kind, required) in SCHEMA.items():
+        if key not in config:
+            if required:
+                raise PlanError('missing key', key)
+        elif not isinstance(config[key], kind):
+            raise PlanError('invalid type', key, type(config[key]).__name__)
+
+    for key in config:
+        if key not in SCHEMA:
+            logger.warning('unknown key {}'.format(key))
+
+    _validate_environment(config['environment'])
+    _validate_database(config.get('database'))
+    _validate_support(config.get('support', []))
+
+    if config.get('simulator', 'host') not in ('host', 'process'):
+        raise PlanError('simulator must be host or process', config['simulator'])
+
+    graphs = {}
+    for phase in PHASES:
+        try:
+            nodes = build_graph(config.get(phase, []))
+        except StepGraphError, e:
+            raise PlanError(phase, *e.args)
+
+        for n in nodes:
+            if not isinstance(n.step, basestring):
+                raise PlanError(phase, 'invalid step', n.name, n.step)
+            cmd = n.step.split(':', 1)[0]
+            if cmd not in actions:
+                raise PlanError(phase, 'unknown step', n.name, cmd)
+        graphs[phase] = nodes
+
+    return RunPlan(sha, config, graphs)
+
+
+class PlanCache(object):
+    """
+    compiled plans keyed by the blob sha of their .psycho.yaml. a push that does
+    not touch .psycho.yaml reuses the plan of the previous one
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        self._plans = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, text, actions):
+        sha = blob_sha(text)
+        with self._lock:
+            plan = self._plans.pop(sha, None)
+            if plan is not None:
+                self._plans[sha] = plan
+                return plan
+
+        plan = compile_plan(text, actions, sha)
+        logger.debug('compiled plan {}'.format(sha))
+        with self._lock:
+            self._plans[sha] = plan
+            while len(self._plans) > self.size:
+                self._plans.popitem(last=False)
+        return plan
+
+
+def _validate_environment(env):
+    if not isinstance(env.get('name'), basestring):
+        raise PlanError('environment', 'missing name')
+    for key in ('dependencies', 'pip'):
+        if key in env and not isinstance(env[key], list):
+            raise PlanError('environment', 'invalid type', key)
+
+
+def _validate_database(d):
+    if d is None:
+        return
+    if not isinstance(d.get('path'), basestring):
+        raise PlanError('database', 'missing path')
+    sql = d.get('sql')
+    if not isinstance(sql, list) or not all(isinstance(s, basestring) for s in sql):
+        raise PlanError('database', 'sql must be a list of strings')
+
+
+def _validate_support(support):
+    for sd in support:
+        if not isinstance(sd, dict):
+            raise PlanError('support', 'invalid entry', sd)
+        if 'root' in sd:
+            continue
+        if not isinstance(sd.get('path'), basestring):
+            raise PlanError('support', 'missing path', sd)
+        if 'text' in sd and not isinstance(sd['text'], basestring):
+            raise PlanError('support', 'text must be a string', sd['path'])
+
+
+plan_cache = PlanCache()
+
+# ============= EOF =============================================
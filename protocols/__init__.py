@@ -20,6 +20,7 @@
 from spectrometer import SpectrometerFactory
 from valve import ValveFactory
 from laser import LaserFactory
+from replay import ReplayFactory
 
 # ============= EOF =============================================
 
@@ -17,14 +17,62 @@
 # ============= enthought library imports =======================
 # ============= standard library imports ========================
 # ============= local library imports  ==========================
+import json
 import logging
+import re
+import time
+from collections import deque
 
-from twisted.internet.protocol import Protocol
+from twisted.internet import reactor
+from twisted.internet.protocol import Protocol, Factory
+
+from protocols.latency import LatencyTable
+from protocols.stats import CommandStats
+
+COMMAND_REGEX = re.compile(r'^_[a-z0-9]+$')
+_dispatch_tables = {}
+
+
+def dispatch_table(klass):
+    """
+    map of lower case command name to method for <klass>, built once per class.
+    a command is any method named _<lowercase letters or digits>, e.g. _getdata
+    for GetData. helpers with an underscore in the name are not commands
+    """
+    table = _dispatch_tables.get(klass)
+    if table is None:
+        table = {}
+        for name in dir(klass):
+            if COMMAND_REGEX.match(name):
+                func = getattr(klass, name)
+                if callable(func):
+                    table[name[1:]] = func
+        _dispatch_tables[klass] = table
+    return table
 
 
 class SimProtocol(Protocol):
+    """
+    commands are newline delimited (a trailing carriage return is ignored) and
+    may arrive split across or packed into TCP segments. every complete command
+    in the buffer is handled and the responses are written in order, each
+    terminated with <terminator>
+
+    replies can be delayed by the device's latency models. delays are scheduled
+    on the reactor so a slow device never blocks the others. replies on one
+    connection keep their order, a fast reply waits behind a slow one like it
+    would on a serial device
+    """
+    delimiter = '\n'
+    terminator = '\r\n'
+    MAX_LENGTH = 16384
+
     def __init__(self):
         self.logger = logging.getLogger(self.__class__.__name__)
+        self._buffer = ''
+        self._commands = dispatch_table(self.__class__)
+        self._pending = deque()
+        self._flush_call = None
 
     def info(self, msg):
         self.logger.info(msg)
@@ -32,23 +80,101 @@ class SimProtocol(Protocol):
     def debug(self, msg):
         self.logger.debug(msg)
 
+    def connectionMade(self):
+        self.factory.connections.add(self)
+
+    def connectionLost(self, reason):
+        self.factory.connections.discard(self)
+        if self._flush_call and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        self._pending.clear()
+
     def dataReceived(self, data):
-        self._handle_data(data)
+        self._buffer += data
+        lines = self._buffer.split(self.delimiter)
+        self._buffer = lines.pop()
+        if len(self._buffer) > self.MAX_LENGTH:
+            self.info('command exceeds {} bytes. dropping connection'.format(self.MAX_LENGTH))
+            self._buffer = ''
+            self.transport.loseConnection()
+            return
+
+        for line in lines:
+            line = line.rstrip('\r')
+            if line:
+                self._handle_data(line)
 
     def _handle_data(self, data):
-        resp = self._generate_response(data)
+        key = data.split(' ', 1)[0].lower()
+        if key not in self._commands:
+            key = 'invalid'
+
+        st = time.time()
+        try:
+            resp = self._generate_response(data)
+        except BaseException:
+            self.factory.stats.record(key, time.time() - st, error=True)
+            raise
         self.debug('{} response ==> {}'.format(data, resp))
-        self.transport.write(resp)
+
+        # the latency a client sees is the handler time plus the modelled delay
+        delay = self.factory.latency.sample(key)
+        self.factory.stats.record(key, time.time() - st + delay, error=key == 'invalid')
+        self._send_reply('{}{}'.format(resp, self.terminator), delay)
+
+    def _send_reply(self, msg, delay):
+        if not delay and not self._pending:
+            self.transport.write(msg)
+            return
+
+        self._pending.append((time.time() + delay, msg))
+        if self._flush_call is None:
+            self._flush_call = reactor.callLater(delay, self._flush_pending)
+
+    def _flush_pending(self):
+        self._flush_call = None
+        now = time.time()
+        while self._pending and self._pending[0][0] <= now:
+            self.transport.write(self._pending.popleft()[1])
+
+        if self._pending:
+            self._flush_call = reactor.callLater(self._pending[0][0] - now, self._flush_pending)
 
     def _generate_response(self, data):
-        args = data.split(' ')
-        cmd, data = args[0], ' '.join(args[1:])
-
-        func = '_{}'.format(cmd.lower())
-        if hasattr(self, func):
-            func = getattr(self, func)
-            return func(data)
-        else:
+        args = data.split(' ', 1)
+        cmd, data = args[0], args[1] if len(args) > 1 else ''
+
+        func = self._commands.get(cmd.lower())
+        if func is None:
             return 'Invalid Command "{}"'.format(cmd)
+        return func(self, data)
+
+    def _stats(self, data):
+        """
+        Stats [reset]. per command counts and latencies of this device as json
+        """
+        ret = json.dumps(self.factory.stats.snapshot())
+        if data.strip().lower() == 'reset':
+            self.factory.stats.reset()
+        return ret
+
+
+class SimFactory(Factory):
+    """
+    base factory for the device simulators. keeps track of open connections so
+    a simulator can be torn down without restarting the reactor, and holds the
+    command statistics shared by all connections to the device
+    """
+
+    def __init__(self, config=None):
+        self.config = config or {}
+        self.connections = set()
+        self.stats = CommandStats()
+        self.latency = LatencyTable(self.config.get('latency'))
+
+    def disconnect_all(self):
+        for p in list(self.connections):
+            p.transport.loseConnection()
 
 # ============= EOF =============================================
@@ -17,9 +17,7 @@
 # ============= enthought library imports =======================
 # ============= standard library imports ========================
 # ============= local library imports  ==========================
-from twisted.internet.protocol import Factory
-
-from protocols.base import SimProtocol
+from protocols.base import SimProtocol, SimFactory
 
 
 class LaserProtocol(SimProtocol):
@@ -35,8 +33,7 @@ class LaserProtocol(SimProtocol):
         return 'OK'
 
 
-class LaserFactory(Factory):
-    def buildProtocol(self, addr):
-        return LaserProtocol()
+class LaserFactory(SimFactory):
+    protocol = LaserProtocol
 
 # ============= EOF =============================================
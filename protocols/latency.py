@@ -0,0 +1,104 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import random
+# ============= local library imports  ==========================
+
+
+class LatencyModel(object):
+    """
+    how long a device takes to answer one command.
+
+    config e.g.
+        fixed: 0.01               # added to every reply
+        distribution: normal      # normal, lognormal, uniform or exponential
+        mean: 0.5
+        sigma: 0.05               # normal and lognormal
+        low: 0.1                  # uniform
+        high: 0.2                 # uniform
+        jitter: 0.005             # +/- uniform jitter
+        slow_probability: 0.01    # chance of an occasional slow reply
+        slow_delay: 2.0           # extra seconds for a slow reply
+    """
+
+    def __init__(self, fixed=0, distribution=None, mean=0, sigma=0, low=0, high=0,
+                 jitter=0, slow_probability=0, slow_delay=0, seed=None):
+        self.fixed = fixed
+        self.distribution = distribution
+        self.mean = mean
+        self.sigma = sigma
+        self.low = low
+        self.high = high
+        self.jitter = jitter
+        self.slow_probability = slow_probability
+        self.slow_delay = slow_delay
+        self._rng = random.Random(seed)
+
+    def sample(self):
+        rng = self._rng
+        d = self.fixed
+        if self.distribution == 'normal':
+            d += rng.gauss(self.mean, self.sigma)
+        elif self.distribution == 'lognormal':
+            d += rng.lognormvariate(self.mean, self.sigma)
+        elif self.distribution == 'uniform':
+            d += rng.uniform(self.low, self.high)
+        elif self.distribution == 'exponential':
+            d += rng.expovariate(1.0 / self.mean) if self.mean else 0
+
+        if self.jitter:
+            d += rng.uniform(-self.jitter, self.jitter)
+        if self.slow_probability and rng.random() < self.slow_probability:
+            d += self.slow_delay
+        return max(d, 0)
+
+
+class LatencyTable(object):
+    """
+    latency model per command of one device.
+
+    config e.g.
+        default:
+          fixed: 0.01
+        Open:
+          distribution: normal
+          mean: 0.5
+          sigma: 0.05
+
+    commands without a model of their own use ``default``. with no config every
+    reply is immediate
+    """
+
+    def __init__(self, config=None):
+        config = config or {}
+        self._default = None
+        self._models = {}
+        for k, v in config.items():
+            model = LatencyModel(**v)
+            if k == 'default':
+                self._default = model
+            else:
+                self._models[k.lower()] = model
+
+    def sample(self, cmd):
+        model = self._models.get(cmd, self._default)
+        if model:
+            return model.sample()
+        return 0
+
+# ============= EOF =============================================
@@ -0,0 +1,230 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import gzip
+import logging
+import struct
+import time
+from collections import deque
+# ============= local library imports  ==========================
+from twisted.internet import reactor
+from twisted.internet.protocol import Protocol, ClientFactory, Factory
+
+from protocols.base import SimProtocol, SimFactory
+
+MAGIC = 'PDTL\x01'
+# time since the start of the recording, reply latency, command length, reply length
+RECORD = struct.Struct('<dfII')
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+class TrafficLogWriter(object):
+    """
+    compact binary log of command/reply exchanges with one device.
+
+    the file starts with MAGIC followed by one RECORD header per exchange and the
+    raw command and reply bytes. paths ending in .gz are gzip compressed
+    """
+
+    def __init__(self, path):
+        self._file = _open(path, 'wb')
+        self._file.write(MAGIC)
+
+    def write(self, t, latency, cmd, resp):
+        self._file.write(RECORD.pack(t, latency, len(cmd), len(resp)))
+        self._file.write(cmd)
+        self._file.write(resp)
+
+    def flush(self):
+        if not self._file.closed:
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_log(path):
+    """
+    iterate over the exchanges in a traffic log
+
+    :return: generator of (t, latency, cmd, resp)
+    """
+    with _open(path, 'rb') as rfile:
+        if rfile.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a traffic log'.format(path))
+
+        while 1:
+            head = rfile.read(RECORD.size)
+            if len(head) < RECORD.size:
+                break
+            t, latency, nc, nr = RECORD.unpack(head)
+            yield t, latency, rfile.read(nc), rfile.read(nr)
+
+
+# record
+class _DeviceClient(Protocol):
+    def connectionMade(self):
+        self.factory.recorder.device_connected(self)
+
+    def dataReceived(self, data):
+        self.factory.recorder.device_data(data)
+
+    def connectionLost(self, reason):
+        self.factory.recorder.transport.loseConnection()
+
+
+class _DeviceClientFactory(ClientFactory):
+    protocol = _DeviceClient
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def clientConnectionFailed(self, connector, reason):
+        self.recorder.device_failed(reason)
+
+
+class RecorderProtocol(Protocol):
+    """
+    transparent proxy between pychron and a real device. every command and the
+    reply to it are appended to the factory's traffic log
+    """
+
+    def connectionMade(self):
+        self._device = None
+        self._commands = deque()
+        self._cbuf = ''
+        self._rbuf = ''
+        self.transport.pauseProducing()
+
+        reactor.connectTCP(self.factory.host, self.factory.port, _DeviceClientFactory(self))
+
+    def device_connected(self, device):
+        self._device = device
+        self.transport.resumeProducing()
+
+    def device_failed(self, reason):
+        # nothing to proxy to. drop pychron's connection instead of leaving it paused
+        logging.getLogger('RecorderFactory').warning('cannot connect to {}:{}. {}'.format(
+            self.factory.host, self.factory.port, reason.getErrorMessage()))
+        self.transport.loseConnection()
+
+    def dataReceived(self, data):
+        self._cbuf += data
+        lines = self._cbuf.split(self.factory.delimiter)
+        self._cbuf = lines.pop()
+        now = time.time()
+        for line in lines:
+            self._commands.append((now, line.rstrip('\r')))
+        self._device.transport.write(data)
+
+    def device_data(self, data):
+        self._rbuf += data
+        replies = self._rbuf.split(self.factory.terminator)
+        self._rbuf = replies.pop()
+        now = time.time()
+        for resp in replies:
+            if self._commands:
+                st, cmd = self._commands.popleft()
+                self.factory.log.write(st - self.factory.start, now - st, cmd, resp)
+        self.transport.write(data)
+
+    def connectionLost(self, reason):
+        if self._device:
+            self._device.transport.loseConnection()
+        self.factory.log.flush()
+
+
+class RecorderFactory(Factory):
+    protocol = RecorderProtocol
+
+    def __init__(self, host, port, path, delimiter='\n', terminator='\r\n'):
+        self.host = host
+        self.port = port
+        self.delimiter = delimiter
+        self.terminator = terminator
+        self.log = TrafficLogWriter(path)
+        self.start = time.time()
+
+
+# replay
+class ReplayProtocol(SimProtocol):
+    """
+    answers commands with the replies from a traffic log.
+
+    each distinct command line is answered with its recorded replies in order.
+    once they are used up the last one is repeated. the recorded latency is
+    divided by the factory's speed. speed 1 is faithful, 10 is ten times faster
+    and 0 answers as fast as possible
+    """
+
+    def _handle_data(self, data):
+        st = time.time()
+        resp, latency = self.factory.lookup(data)
+        if resp is None:
+            key, resp, delay = 'invalid', 'Invalid Command "{}"'.format(data), 0
+        else:
+            key, delay = data.split(' ', 1)[0].lower(), self.factory.scale(latency)
+
+        # record the latency actually served, as SimProtocol does
+        self.factory.stats.record(key, time.time() - st + delay, error=key == 'invalid')
+        self.debug('{} replay ==> {}'.format(data, resp))
+        self._send_reply('{}{}'.format(resp, self.terminator), delay)
+
+
+class ReplayFactory(SimFactory):
+    """
+    config e.g.
+        replay:
+          path: valve.pdtl
+          speed: 10
+    """
+    protocol = ReplayProtocol
+
+    def __init__(self, config=None):
+        SimFactory.__init__(self, config)
+        replay = self.config['replay']
+        self.speed = float(replay.get('speed', 1))
+        self._exchanges = {}
+        self._cursors = {}
+
+        n = 0
+        for _, latency, cmd, resp in read_log(replay['path']):
+            self._exchanges.setdefault(cmd, []).append((resp, latency))
+            n += 1
+        logging.getLogger('ReplayFactory').info('loaded {} exchanges from {}'.format(n, replay['path']))
+
+    def lookup(self, cmd):
+        exchanges = self._exchanges.get(cmd)
+        if not exchanges:
+            return None, 0
+
+        i = self._cursors.get(cmd, 0)
+        self._cursors[cmd] = i + 1
+        return exchanges[min(i, len(exchanges) - 1)]
+
+    def scale(self, latency):
+        if self.speed <= 0:
+            return 0
+        return latency / self.speed
+
+# ============= EOF =============================================
@@ -0,0 +1,110 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import struct
+import time
+from cStringIO import StringIO
+
+import numpy as np
+# ============= local library imports  ==========================
+
+DEFAULT_ISOTOPES = (('Ar40', 100.0),
+                    ('Ar39', 10.0),
+                    ('Ar38', 1.0),
+                    ('Ar37', 0.5),
+                    ('Ar36', 0.3))
+
+
+class SignalModel(object):
+    """
+    vectorized model of the detector signals of a multi-collector spectrometer.
+
+    each isotope has a constant intensity. every frame adds a common baseline that
+    drifts linearly with time and independent gaussian noise on every channel.
+    frames are generated in blocks with numpy so there is no per-sample python work
+
+    config e.g.
+        isotopes:
+          Ar40: 100
+          Ar36: 0.3
+        noise: 0.01
+        baseline: 0.002
+        drift: 0.0001
+        seed: 1
+    """
+
+    def __init__(self, isotopes=None, noise=0.01, baseline=0.0, drift=0.0, seed=None):
+        if isotopes is None:
+            isotopes = DEFAULT_ISOTOPES
+        elif isinstance(isotopes, dict):
+            isotopes = sorted(isotopes.items())
+
+        self.names = [n for n, _ in isotopes]
+        self.intensities = np.array([float(i) for _, i in isotopes])
+        self.noise = noise
+        self.baseline = baseline
+        self.drift = drift
+        self._rng = np.random.RandomState(seed)
+        self._t0 = time.time()
+
+    @classmethod
+    def from_config(cls, config):
+        config = config or {}
+        return cls(isotopes=config.get('isotopes'),
+                   noise=config.get('noise', 0.01),
+                   baseline=config.get('baseline', 0.0),
+                   drift=config.get('drift', 0.0),
+                   seed=config.get('seed'))
+
+    def sample(self, n, start=None, rate=1.0):
+        """
+        :param n: number of frames
+        :param start: time of the first frame. defaults to now
+        :param rate: frames per second
+        :return: array of shape (n, 1 + number of isotopes). column 0 is the time
+        """
+        if start is None:
+            start = time.time()
+
+        k = len(self.names)
+        out = np.empty((n, k + 1))
+        out[:, 0] = start + np.arange(n) / float(rate)
+
+        base = self.baseline + self.drift * (out[:, 0] - self._t0)
+        out[:, 1:] = self.intensities + base[:, None] + self._rng.normal(0, self.noise, (n, k))
+        return out
+
+
+def encode_ascii(frames):
+    """
+    one comma separated line per frame
+    """
+    buf = StringIO()
+    np.savetxt(buf, frames, fmt='%.6f', delimiter=',', newline='\r\n')
+    return buf.getvalue()
+
+
+def encode_binary(frames):
+    """
+    'DATA', uint32 number of frames, uint32 values per frame then the frames as
+    little endian float64
+    """
+    n, k = frames.shape
+    return 'DATA' + struct.pack('<II', n, k) + frames.astype('<f8').tostring()
+
+# ============= EOF =============================================
@@ -16,28 +16,130 @@
 
 # ============= enthought library imports =======================
 # ============= standard library imports ========================
+import time
 # ============= local library imports  ==========================
-from twisted.internet.protocol import Factory
+from twisted.internet.task import LoopingCall
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
 
-from protocols.base import SimProtocol
+from protocols.base import SimProtocol, SimFactory
+from protocols.signal_model import SignalModel, encode_ascii, encode_binary
+
+MIN_TICK = 0.01
+
+
+@implementer(IPushProducer)
+class FrameStream(object):
+    """
+    push frames to a connection at <rate> frames per second.
+
+    frames are generated in one numpy block per tick of at most MIN_TICK. the
+    stream registers as a producer on the transport. while the client is not
+    keeping up the stream is paused and the frames it would have sent are
+    counted in ``dropped``
+    """
+
+    def __init__(self, protocol, rate, encode):
+        self.protocol = protocol
+        self.rate = rate
+        self.encode = encode
+        self.sent = 0
+        self.dropped = 0
+        self._paused = False
+        self._st = time.time()
+        self._loop = LoopingCall(self._tick)
+
+    def start(self):
+        self.protocol.transport.registerProducer(self, True)
+        self._loop.start(max(1.0 / self.rate, MIN_TICK), now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+        self.protocol.transport.unregisterProducer()
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+
+    def stopProducing(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def _tick(self):
+        due = int((time.time() - self._st) * self.rate)
+        n = due - self.sent - self.dropped
+        if n <= 0:
+            return
+
+        if self._paused:
+            self.dropped += n
+            return
+
+        start = self._st + (self.sent + self.dropped) / float(self.rate)
+        frames = self.protocol.factory.signal.sample(n, start=start, rate=self.rate)
+        self.protocol.transport.write(self.encode(frames))
+        self.sent += n
 
 
 class SpectrometerProtocol(SimProtocol):
-    _dac = 0
+    _stream = None
+
+    def connectionLost(self, reason):
+        self._stop_stream()
+        SimProtocol.connectionLost(self, reason)
 
     def _getdata(self, data):
-        return '12341234'
+        frame = self.factory.signal.sample(1)
+        return ','.join('{:0.6f}'.format(v) for v in frame[0, 1:])
+
+    def _getisotopes(self, data):
+        return ','.join(self.factory.signal.names)
 
     def _setdac(self, data):
-        SimProtocol._dac = data
+        self.factory.dac = data
         return 'OK'
 
     def _getdac(self, data):
-        return SimProtocol._dac
+        return self.factory.dac
+
+    def _startstream(self, data):
+        """
+        StartStream <rate>[,<ascii|binary>]
+
+        push frames at <rate> per second until StopStream. ascii frames are comma
+        separated lines, binary frames are described in signal_model.encode_binary
+        """
+        args = [a.strip() for a in data.split(',')] if data else []
+        rate = float(args[0]) if args else 10
+        encode = encode_ascii if len(args) > 1 and args[1].lower() == 'ascii' else encode_binary
+
+        self._stop_stream()
+        self._stream = FrameStream(self, rate, encode)
+        self._stream.start()
+        return 'OK'
+
+    def _stopstream(self, data):
+        stream = self._stop_stream()
+        if stream:
+            return 'OK sent={} dropped={}'.format(stream.sent, stream.dropped)
+        return 'OK'
+
+    def _stop_stream(self):
+        stream, self._stream = self._stream, None
+        if stream:
+            stream.stop()
+        return stream
+
 
+class SpectrometerFactory(SimFactory):
+    protocol = SpectrometerProtocol
 
-class SpectrometerFactory(Factory):
-    def buildProtocol(self, addr):
-        return SpectrometerProtocol()
+    def __init__(self, config=None):
+        SimFactory.__init__(self, config)
+        self.dac = 0
+        self.signal = SignalModel.from_config(self.config)
 
 # ============= EOF =============================================
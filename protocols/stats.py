@@ -0,0 +1,86 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import math
+# ============= local library imports  ==========================
+
+# upper edges of the latency histogram buckets in seconds. 1us doubling up to ~33s
+BUCKETS = [1e-6 * 2 ** i for i in range(26)]
+
+
+def bucket_index(dt):
+    if dt <= BUCKETS[0]:
+        return 0
+    return min(int(math.ceil(math.log(dt / BUCKETS[0], 2))), len(BUCKETS))
+
+
+class CommandStats(object):
+    """
+    per command counters and latency histograms for one device simulator.
+
+    the histogram has log2 buckets so recording is O(1) and percentiles are
+    accurate to within a factor of two
+    """
+
+    def __init__(self):
+        self._commands = {}
+
+    def record(self, cmd, dt, error=False):
+        s = self._commands.get(cmd)
+        if s is None:
+            s = self._commands[cmd] = {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0,
+                                       'histogram': [0] * (len(BUCKETS) + 1)}
+        s['count'] += 1
+        s['total'] += dt
+        if dt > s['max']:
+            s['max'] = dt
+        if error:
+            s['errors'] += 1
+        s['histogram'][bucket_index(dt)] += 1
+
+    def snapshot(self):
+        ret = {}
+        for cmd, s in self._commands.items():
+            n = s['count']
+            ret[cmd] = {'count': n,
+                        'errors': s['errors'],
+                        'mean': s['total'] / n if n else 0,
+                        'max': s['max'],
+                        'p50': self._percentile(s['histogram'], n, 0.5),
+                        'p95': self._percentile(s['histogram'], n, 0.95),
+                        'p99': self._percentile(s['histogram'], n, 0.99),
+                        'histogram': dict((str(BUCKETS[i]) if i < len(BUCKETS) else 'inf', c)
+                                          for i, c in enumerate(s['histogram']) if c)}
+        return ret
+
+    def reset(self):
+        self._commands = {}
+
+    def _percentile(self, histogram, n, q):
+        """
+        upper edge of the bucket holding the <q> quantile
+        """
+        target = q * n
+        acc = 0
+        for i, c in enumerate(histogram):
+            acc += c
+            if c and acc >= target:
+                return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+        return 0
+
+# ============= EOF =============================================
@@ -17,9 +17,7 @@
 # ============= enthought library imports =======================
 # ============= standard library imports ========================
 # ============= local library imports  ==========================
-from twisted.internet.protocol import Factory
-
-from protocols.base import SimProtocol
+from protocols.base import SimProtocol, SimFactory
 
 
 class ValveProtocol(SimProtocol):
@@ -31,9 +29,8 @@ class ValveProtocol(SimProtocol):
         return 'OK'
 
 
-class ValveFactory(Factory):
-    def buildProtocol(self, addr):
-        return ValveProtocol()
+class ValveFactory(SimFactory):
+    protocol = ValveProtocol
 
 # ============= EOF =============================================
 
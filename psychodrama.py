@@ -18,10 +18,17 @@
 # ============= standard library imports ========================
 import logging
 import re
-from flask import Flask, Blueprint, request, render_template
+import time
+from Queue import Empty
+
+from flask import Flask, Blueprint, Response, request, render_template, jsonify, stream_with_context, abort
 # ============= local library imports  ==========================
 
-from runner import PsychoDramaRunner
+from envcache import env_cache
+from events import event_bus, format_sse, EventLogHandler
+from joblog import setup_logging
+from result_writer import RESULTS_DB, result_writer
+from scheduler import RunScheduler
 
 
 class PsychoDramaApp(Flask):
@@ -30,26 +37,16 @@ class PsychoDramaApp(Flask):
 
 app = PsychoDramaApp('PsychoDrama')
 
-root_logger = logging.getLogger()
-root_logger.setLevel(logging.DEBUG)
-
-shandler = logging.StreamHandler()
-fhandler = logging.FileHandler('psychodrama.log', mode='w')
-
-handlers = [shandler, fhandler]
-NAME_WIDTH = 40
-gFORMAT = '%(name)-{}s: %(asctime)s %(levelname)-9s (%(threadName)-10s) %(message)s'.format(NAME_WIDTH)
-for hi in handlers:
-    hi.setLevel(logging.DEBUG)
-    hi.setFormatter(logging.Formatter(gFORMAT))
-    root_logger.addHandler(hi)
 
-
-def webhook_blueprint(branches=None):
+def webhook_blueprint(scheduler, branches=None):
     """
      if <branches> is None trigger handle webhooks for all branches
      else only for <branches>
 
+     matching pushes are queued on <scheduler>. returns 202 if the run was queued
+     or 503 if the queue is full
+
+    :param scheduler: RunScheduler
     :param branches:
     :return:
     """
@@ -58,59 +55,181 @@ def webhook_blueprint(branches=None):
     webhook_logger = logging.getLogger('webhook')
     webhook_logger.setLevel(logging.DEBUG)
 
+    def matches(ref):
+        if branches:
+            for b in branches:
+                bb = 'refs/heads/{}'.format(b)
+                if re.match(bb, ref):
+                    return True
+        else:
+            return True
+
     @bp.route('/payload', methods=['POST', 'GET'])
     def payload():
 
-        webhook_logger.info('received payload')
         data = request.get_json()
-        webhook_logger.debug(data)
-
         ref = data.get('ref', '')
+        webhook_logger.info('received payload ref={} sha={} commits={} user={}'.format(ref,
+                                                                                     data.get('checkout_sha'),
+                                                                                     len(data.get('commits', [])),
+                                                                                     data.get('user_name')))
+        if not matches(ref):
+            return 'OK'
 
-        if branches:
-            for b in branches:
-                bb = 'refs/heads/{}'.format(b)
-                if re.match(bb, ref):
-                    runner = PsychoDramaRunner()
-                    runner.bootstrap(data)
-                    break
-        else:
-            runner = PsychoDramaRunner()
-            runner.bootstrap(data)
+        job = scheduler.submit(data)
+        if job is None:
+            return 'Busy', 503
 
-        return 'OK'
+        return 'Accepted', 202
+
+    @bp.route('/queue')
+    def queue():
+        return jsonify(scheduler.metrics())
 
     return bp
 
 
 def results_blueprint():
-    from models import ResultTbl
+    from models import query_results, query_spans, decode_cursor
     bp = Blueprint('results', __name__, template_folder='templates')
 
+    def page():
+        limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+        before = request.args.get('before')
+        if before:
+            try:
+                decode_cursor(before)
+            except ValueError:
+                # a truncated or hand edited "before" cursor
+                abort(400)
+
+        return query_results(branch=request.args.get('branch'),
+                             status=request.args.get('status'),
+                             before=before,
+                             limit=limit)
+
     @bp.route('/results')
     def results():
-        rs = ResultTbl.query.order_by(ResultTbl.pub_date.desc())
+        rs, cursor = page()
+        spans = query_spans([ri.id for ri in rs])
+
+        rs = [{'date': ri.pub_date, 'msg': ri.fmsg, 'status': ri.status, 'duration': ri.fduration,
+               'branch': ri.branch, 'sha': ri.sha, 'commits': ri.commit_list,
+               'spans': spans.get(ri.id, [])} for ri in rs]
+        return render_template('results.html', results=rs, cursor=cursor,
+                               branch=request.args.get('branch', ''),
+                               status=request.args.get('status', ''),
+                               live=not request.args.get('before'))
+
+    @bp.route('/results.json')
+    def results_json():
+        rs, cursor = page()
+        spans = query_spans([ri.id for ri in rs])
+
+        results = []
+        for ri in rs:
+            r = ri.to_dict()
+            r['spans'] = [si.to_dict() for si in spans.get(ri.id, [])]
+            results.append(r)
+        return jsonify(results=results, next=cursor)
 
-        rs = [{'date': ri.pub_date, 'msg': ri.msg, 'status': ri.status, 'duration': ri.fduration} for ri in rs]
-        return render_template('results.html', results=rs)
+    return bp
+
+
+def events_blueprint(keepalive=15, max_age=300):
+    """
+    live job progress as server-sent events. job, phase, step, log and result
+    events are published while runs are in progress. see events.EventBus
+
+    every client holds a connection open so run the app threaded, see run.py
+    and gunicorn.conf.py. a stream is closed after <max_age> seconds so a
+    connection never holds a worker for good, the browser reconnects and
+    resumes from the last event id it saw
+    """
+    bp = Blueprint('events', __name__)
+
+    @bp.route('/events')
+    def events():
+        last_id = request.headers.get('Last-Event-ID', type=int)
+        sub = event_bus.subscribe(last_id)
+
+        def stream():
+            deadline = time.time() + max_age
+            try:
+                # reconnect quickly once the stream is closed
+                yield 'retry: 1000\n\n'
+                while not sub.overflowed:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        event = sub.queue.get(timeout=min(keepalive, remaining))
+                    except Empty:
+                        yield ': keepalive\n\n'
+                        continue
+                    yield format_sse(event)
+                # too old or too far behind. the client reconnects and catches up
+                # from the history
+            finally:
+                event_bus.unsubscribe(sub)
+
+        return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    return bp
+
+
+def simulator_blueprint():
+    from simulator import sim_host
+    bp = Blueprint('simulators', __name__)
+
+    @bp.route('/simulators/stats')
+    def stats():
+        return jsonify(sim_host.stats())
 
     return bp
 
 
 def setup_db():
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/results.sqlite3'
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(RESULTS_DB)
     from models import create_db
     create_db()
 
 
-def bootstrap():
+def bootstrap(workers=None, queue_size=None):
+    """
+    :param workers: number of concurrent psychodrama runs
+    :param queue_size: max number of runs waiting for a worker
+    :return:
+    """
+    setup_logging(root=app.config.get('PSYCHODRAMA_LOG_DIR', 'logs'),
+                  max_bytes=app.config.get('PSYCHODRAMA_LOG_MAX_BYTES', 50 * 1024 ** 2),
+                  backups=app.config.get('PSYCHODRAMA_LOG_BACKUPS', 5),
+                  handlers=[EventLogHandler(event_bus)])
+
+    if workers is None:
+        workers = app.config.get('PSYCHODRAMA_WORKERS', 1)
+    if queue_size is None:
+        queue_size = app.config.get('PSYCHODRAMA_QUEUE_SIZE', 10)
+
+    env_cache.budget = app.config.get('PSYCHODRAMA_ENV_BUDGET', env_cache.budget)
+
+    detector = result_writer.detector
+    detector.window = app.config.get('PSYCHODRAMA_REGRESSION_WINDOW', detector.window)
+    detector.threshold = app.config.get('PSYCHODRAMA_REGRESSION_THRESHOLD', detector.threshold)
+
     @app.route('/')
     def index():
         return render_template('index.html')
 
+    scheduler = RunScheduler(workers=workers, queue_size=queue_size)
+    scheduler.start()
+
     # setup blueprints
-    app.register_blueprint(webhook_blueprint(branches=['develop', 'release-*', 'feature/*']))
+    app.register_blueprint(webhook_blueprint(scheduler, branches=['develop', 'release-*', 'feature/*']))
     app.register_blueprint(results_blueprint())
+    app.register_blueprint(simulator_blueprint())
+    app.register_blueprint(events_blueprint())
 
     # setup database
     setup_db()
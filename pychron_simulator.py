@@ -17,10 +17,55 @@
 # ============= enthought library imports =======================
 # ============= standard library imports ========================
 # ============= local library imports  ==========================
+import argparse
+
+import yaml
+
 from simulator import Simulator
 
+
+def port_range(s):
+    """
+    "9000-9100" => [9000, ..., 9100]
+    """
+    lo, hi = map(int, s.split('-'))
+    return range(lo, hi + 1)
+
+
 if __name__ == '__main__':
-    sim = Simulator()
+    parser = argparse.ArgumentParser(description='Run the pychron device simulators')
+    parser.add_argument('--host',
+                        type=str,
+                        default='127.0.0.1',
+                        help='interface to listen on')
+    parser.add_argument('--ephemeral',
+                        action='store_true',
+                        default=False,
+                        help='let the OS pick free ports')
+    parser.add_argument('--port-pool',
+                        type=port_range,
+                        default=None,
+                        help='range of ports to choose from e.g. 9000-9100')
+    parser.add_argument('--ports-file',
+                        type=str,
+                        default=None,
+                        help='write the bound ports to this file as json')
+    parser.add_argument('--config',
+                        type=str,
+                        default=None,
+                        help='yaml file with per device configuration')
+    args = parser.parse_args()
+
+    config = None
+    if args.config:
+        with open(args.config, 'r') as rfile:
+            config = yaml.safe_load(rfile)
+
+    sim = Simulator(host=args.host,
+                    ephemeral=args.ephemeral,
+                    port_pool=args.port_pool,
+                    ports_file=args.ports_file,
+                    config=config)
     sim.bootstrap()
 
 # ============= EOF =============================================
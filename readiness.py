@@ -0,0 +1,111 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import os
+import select
+import socket
+import time
+# ============= local library imports  ==========================
+
+
+def probe_tcp(host, port):
+    """
+    True if something is listening on <host>:<port>
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(0.5)
+    try:
+        s.connect((host, port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+
+class ReadyListener(object):
+    """
+    unix socket a child process connects to when it is ready. the path is handed
+    to the child in the PSYCHODRAMA_READY_SOCKET environment variable. the child
+    connects and sends READY
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen(1)
+        self.ready = False
+
+    def wait(self, timeout):
+        """
+        block for up to <timeout> seconds for the ready message
+        """
+        if not self.ready:
+            r, _, _ = select.select([self._sock], [], [], timeout)
+            if r:
+                conn, _ = self._sock.accept()
+                conn.settimeout(1)
+                try:
+                    self.ready = conn.recv(64).strip() == 'READY'
+                except socket.error:
+                    pass
+                finally:
+                    conn.close()
+        return self.ready
+
+    def close(self):
+        self._sock.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def wait_for(probe, timeout=60, listener=None, initial=0.01, factor=2, max_interval=1):
+    """
+    wait until <probe> returns True or <listener> receives its ready message.
+
+    the probe is retried with exponential backoff starting at <initial> seconds
+    and capped at <max_interval>. between probes the wait is spent blocked on
+    <listener> so a ready notification ends the wait immediately. <probe> may
+    raise to abort the wait e.g. when the process it is waiting on has died
+
+    :return: seconds until ready or None if <timeout> expired
+    """
+    st = time.time()
+    interval = initial
+    while 1:
+        if probe():
+            return time.time() - st
+
+        remaining = timeout - (time.time() - st)
+        if remaining <= 0:
+            return
+
+        delay = min(interval, remaining)
+        if listener:
+            if listener.wait(delay):
+                return time.time() - st
+        else:
+            time.sleep(delay)
+
+        interval = min(interval * factor, max_interval)
+
+# ============= EOF =============================================
@@ -0,0 +1,83 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import argparse
+import logging
+import os
+
+from twisted.internet import reactor
+# ============= local library imports  ==========================
+from protocols.replay import RecorderFactory
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('psychodrama_recorder')
+
+
+def proxy_spec(s):
+    """
+    "Valve,9000,192.168.0.10,4000" => ('Valve', 9000, '192.168.0.10', 4000)
+    """
+    name, listen, host, port = s.split(',')
+    return name, int(listen), host, int(port)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record the traffic between pychron and real devices. '
+                                                 'point pychron at the listen ports instead of the devices')
+    parser.add_argument('--proxy',
+                        type=proxy_spec,
+                        action='append',
+                        required=True,
+                        help='name,listen_port,device_host,device_port. may be repeated')
+    parser.add_argument('--output-dir',
+                        type=str,
+                        default='.',
+                        help='a <name>.pdtl traffic log is written here for every device')
+    parser.add_argument('--gzip',
+                        action='store_true',
+                        default=False,
+                        help='gzip compress the traffic logs')
+    parser.add_argument('--delimiter',
+                        type=str,
+                        default='\\n',
+                        help='command delimiter')
+    parser.add_argument('--terminator',
+                        type=str,
+                        default='\\r\\n',
+                        help='reply terminator')
+    args = parser.parse_args()
+
+    delimiter = args.delimiter.decode('string_escape')
+    terminator = args.terminator.decode('string_escape')
+    ext = '.pdtl.gz' if args.gzip else '.pdtl'
+
+    factories = []
+    for name, listen, host, port in args.proxy:
+        path = os.path.join(args.output_dir, '{}{}'.format(name.lower(), ext))
+        factory = RecorderFactory(host, port, path, delimiter=delimiter, terminator=terminator)
+        reactor.listenTCP(listen, factory)
+        factories.append(factory)
+        logger.info('recording {} {}:{} on {} to {}'.format(name, host, port, listen, path))
+
+    try:
+        reactor.run()
+    finally:
+        for f in factories:
+            f.log.close()
+
+# ============= EOF =============================================
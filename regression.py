@@ -0,0 +1,118 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import logging
+import math
+# ============= local library imports  ==========================
+logger = logging.getLogger('psychodrama_regression')
+logger.setLevel(logging.DEBUG)
+
+TOTAL = ('total', 'total', None)
+
+
+class Regression(object):
+    def __init__(self, key, value, mean, std, n):
+        self.key = key
+        self.value = value
+        self.mean = mean
+        self.std = std
+        self.n = n
+
+    @property
+    def z(self):
+        return (self.value - self.mean) / self.std
+
+    def __str__(self):
+        kind, name, parent = self.key
+        if parent:
+            name = '{}/{}'.format(parent, name)
+        return '{} {:0.2f}s (baseline {:0.2f}s +/-{:0.2f} over {} runs, z={:0.1f})'.format(name, self.value,
+                                                                                      self.mean, self.std,
+                                                                                      self.n, self.z)
+
+
+class RegressionDetector(object):
+    """
+    compares a run's total duration and timing spans with a rolling baseline
+    made of the last <window> successful runs of the same branch.
+
+    a duration is a regression if it is more than <threshold> standard
+    deviations above the baseline mean and at least <min_delta> seconds slower.
+    a timing needs <min_runs> runs in the baseline before it is checked. the
+    standard deviation is at least <rel_floor> of the mean so a very steady
+    step is not flagged for noise
+
+    runs flagged as regressions stay in the baseline so it follows a slowdown
+    that is kept and only the push that caused it is flagged
+    """
+
+    def __init__(self, window=20, threshold=3.0, min_runs=5, min_delta=0.5, rel_floor=0.05):
+        self.window = window
+        self.threshold = threshold
+        self.min_runs = min_runs
+        self.min_delta = min_delta
+        self.rel_floor = rel_floor
+
+    def check(self, cur, branch, duration, spans):
+        """
+        must be called before the run is inserted
+
+        :param cur: sqlite3 cursor on the results database
+        :param spans: list of (kind, name, parent, start, duration)
+        :return: list of Regression
+        """
+        if not branch:
+            return []
+
+        baseline = self._baseline(cur, branch)
+        timings = [(TOTAL, duration)] + [((kind, name, parent), dur) for kind, name, parent, _, dur in spans]
+
+        regressions = []
+        for key, value in timings:
+            values = baseline.get(key)
+            if not values or len(values) < self.min_runs:
+                continue
+
+            n = len(values)
+            mean = sum(values) / n
+            std = math.sqrt(sum((v - mean) ** 2 for v in values) / n)
+            std = max(std, mean * self.rel_floor, 1e-6)
+
+            r = Regression(key, value, mean, std, n)
+            if r.z > self.threshold and value - mean >= self.min_delta:
+                logger.info('regression on {}: {}'.format(branch, r))
+                regressions.append(r)
+
+        return regressions
+
+    # private
+    def _baseline(self, cur, branch):
+        cur.execute('''select id, duration from ResultTbl where branch=? and status in ('success', 'regression')
+        order by pub_date desc, id desc limit ?''', (branch, self.window))
+        rows = cur.fetchall()
+        if not rows:
+            return {}
+
+        baseline = {TOTAL: [dur for _, dur in rows]}
+        cur.execute('''select kind, name, parent, duration from TimingSpanTbl
+        where result_id in ({})'''.format(','.join('?' * len(rows))), [rid for rid, _ in rows])
+        for kind, name, parent, dur in cur.fetchall():
+            baseline.setdefault((kind, name, parent), []).append(dur)
+        return baseline
+
+# ============= EOF =============================================
@@ -0,0 +1,165 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import logging
+import sqlite3
+from Queue import Queue, Empty
+from threading import Thread, Lock
+# ============= local library imports  ==========================
+from events import event_bus
+from regression import RegressionDetector
+
+logger = logging.getLogger('psychodrama_results')
+logger.setLevel(logging.DEBUG)
+
+RESULTS_DB = '/tmp/results.sqlite3'
+
+
+class ResultWriter(object):
+    """
+    the only writer of the results database.
+
+    runners hand results to ``write`` which returns immediately. a single
+    thread inserts them with parameterized statements and commits whatever is
+    waiting in one transaction. each result is inserted under its own savepoint
+    so a bad one is logged and skipped without losing the rest of the batch.
+    the database runs in WAL mode so the results page can read while a batch is
+    being written.
+
+    successful runs are checked against the branch's baseline by <detector>
+    before they are inserted and get the status "regression" if they are slower
+    """
+
+    def __init__(self, path=RESULTS_DB, batch_size=50, detector=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.detector = detector or RegressionDetector()
+        self._queue = Queue()
+        self._thread = None
+        self._lock = Lock()
+
+    def write(self, result):
+        """
+        queue <result> for insertion into ResultTbl
+
+        :param result: dict with msg, pub_date, status, duration, branch, sha and
+        optionally commits, a json list of the pushed commits, and spans, a
+        list of (kind, name, parent, start, duration) stored in TimingSpanTbl.
+        a "result" event is published once it is committed, tagged with the
+        optional job_id
+        """
+        self._start()
+        self._queue.put(result)
+
+    def flush(self):
+        """
+        block until every queued result has been committed
+        """
+        self._queue.join()
+
+    # private
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.isAlive():
+                self._thread = Thread(target=self._run, name='result-writer')
+                self._thread.setDaemon(True)
+                self._thread.start()
+
+    def _connect(self):
+        # transactions are managed explicitly so savepoints are not committed
+        # implicitly
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _run(self):
+        conn = self._connect()
+        while 1:
+            items = [self._queue.get()]
+            # drain whatever else is waiting so it shares one commit
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except Empty:
+                    break
+
+            try:
+                written = self._write_batch(conn, items)
+                # only announce results once they are committed
+                for item, (rid, status, msg) in written:
+                    event_bus.publish('result', id=rid, job_id=item.get('job_id'), status=status, msg=msg,
+                                      date=item['pub_date'], duration=item['duration'],
+                                      branch=item['branch'])
+            except BaseException:
+                # keep the writer alive, later results must still be written
+                logger.exception('failed to write {} results'.format(len(items)))
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    def _write_batch(self, conn, items):
+        cur = conn.cursor()
+        cur.execute('BEGIN')
+        try:
+            written = []
+            for item in items:
+                cur.execute('SAVEPOINT result')
+                try:
+                    written.append((item, self._insert(cur, item)))
+                except Exception:
+                    cur.execute('ROLLBACK TO result')
+                    logger.exception('skipping result for {} {}'.format(item.get('branch'), item.get('sha')))
+                cur.execute('RELEASE result')
+            cur.execute('COMMIT')
+        except BaseException:
+            try:
+                cur.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+            raise
+        return written
+
+    def _insert(self, cur, item):
+        msg, status = item['msg'], item['status']
+        if isinstance(msg, unicode):
+            msg = msg.encode('utf-8')
+        spans = item.get('spans') or []
+
+        regressed = set()
+        if status == 'success' and self.detector:
+            regressions = self.detector.check(cur, item['branch'], item['duration'], spans)
+            if regressions:
+                status = 'regression'
+                msg = '{}. slower than baseline: {}'.format(msg, '; '.join(str(r) for r in regressions))
+                regressed = set(r.key for r in regressions)
+
+        cur.execute('''insert into ResultTbl (msg, pub_date, status, duration, branch, sha, commits)
+        values (?, ?, ?, ?, ?, ?, ?)''', (sqlite3.Binary(msg), item['pub_date'], status, item['duration'],
+                                          item['branch'], item['sha'], item.get('commits')))
+        rid = cur.lastrowid
+
+        if spans:
+            cur.executemany('''insert into TimingSpanTbl (result_id, kind, name, parent, start, duration, regressed)
+            values (?, ?, ?, ?, ?, ?, ?)''', [(rid,) + tuple(si) + (tuple(si[:3]) in regressed,) for si in spans])
+        return rid, status, msg.decode('utf-8', 'replace')
+
+
+result_writer = ResultWriter()
+
+# ============= EOF =============================================
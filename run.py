@@ -23,10 +23,12 @@ import argparse
 
 def pd(arg_space):
     from psychodrama import bootstrap
-    app = bootstrap()
+    app = bootstrap(workers=arg_space.workers,
+                    queue_size=arg_space.queue_size)
     app.run(host=arg_space.host,
             port=arg_space.port,
-            debug=arg_space.debug)
+            debug=arg_space.debug,
+            threaded=True)
 
 
 if __name__ == '__main__':
@@ -40,6 +42,14 @@ if __name__ == '__main__':
                         type=int,
                         default=4567,
                         help='port for Flask')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='number of concurrent psychodrama runs')
+    parser.add_argument('--queue-size',
+                        type=int,
+                        default=10,
+                        help='max number of runs waiting for a worker')
     parser.add_argument('--debug',
                         action='store_true',
                         default=False,
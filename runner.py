@@ -17,20 +17,42 @@
 # ============= enthought library imports =======================
 # ============= standard library imports ========================
 import logging
+import json
 import os
+import re
+import shutil
 import socket
 import subprocess
 import time
-import sqlite3
 import yaml
-import json
 from datetime import datetime
 from git import Repo
-from threading import Thread
+from threading import Thread, Event
 # ============= local library imports  ==========================
+from control import ControlClient, ControlError
+from dag import execute
+from dbtemplate import db_templates
+from envcache import env_cache
+from events import event_bus
+from fileutil import makedirs
+from joblog import job_context, close_job_log
+from mirror import RepoMirror
+from plan import plan_cache
+from readiness import ReadyListener, probe_tcp, wait_for
+from result_writer import result_writer
+from simulator import sim_host
+from support import SupportTree, atomic_write
+from wheelhouse import wheelhouse_path, PipTimer
+
 logger = logging.getLogger('psychodrama_runner')
 logger.setLevel(logging.DEBUG)
 
+DATE_FMT = '%Y-%m-%d %H:%M:%S.%f'
+# longest a single readiness probe may wait for an answer. the same as the
+# longest interval between probes, see readiness.wait_for
+PROBE_TIMEOUT = 1
+PLACEHOLDER_REGEX = re.compile(r'\$\{(PSYCHODRAMA_\w+)\}')
+
 
 class SupportException(BaseException):
     def __str__(self):
@@ -57,6 +79,16 @@ class NoEndpointException(BaseException):
         return 'NoEndpointException'
 
 
+class SupersededException(BaseException):
+    def __str__(self):
+        return 'SupersededException'
+
+
+class NotReadyException(BaseException):
+    def __str__(self):
+        return 'NotReadyException {}'.format(self.args)
+
+
 class SupportCTX(object):
     def __init__(self, root):
         self._root = root
@@ -68,6 +100,46 @@ class SupportCTX(object):
         pass
 
 
+class SpanCTX(object):
+    """
+    time the body of the with block and add it to the runner's spans, also
+    when the body raises
+    """
+
+    def __init__(self, runner, kind, name, parent=None):
+        self._runner = runner
+        self._kind = kind
+        self._name = name
+        self._parent = parent
+
+    def __enter__(self):
+        self._st = time.time()
+        event_bus.publish(self._kind, job_id=self._runner.job_id, name=self._name, state='started')
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        dur = time.time() - self._st
+        self._runner.spans.append((self._kind, self._name, self._parent, self._st, dur))
+        self._runner.debug('{} {} took {:0.2f}s'.format(self._kind, self._name, dur))
+        event_bus.publish(self._kind, job_id=self._runner.job_id, name=self._name,
+                          state='failed' if exc_type else 'finished', duration=dur)
+
+
+def action(func):
+    """
+    mark a runner method as a step .psycho.yaml can use
+    """
+    func.is_action = True
+    return func
+
+
+def action_names(klass):
+    """
+    names of the @action methods of <klass> without the leading underscore
+    """
+    return tuple(sorted(name[1:] for name in dir(klass)
+                        if getattr(getattr(klass, name), 'is_action', False)))
+
+
 class PsychoDramaRunner:
     """
     example config
@@ -94,44 +166,118 @@ class PsychoDramaRunner:
       - start_sim:PychronSimulator
       - start_app:PyExperiment
 
+    steps run in order unless grouped with ``parallel`` or given
+    explicit ``needs``. see dag.build_graph
+
     run:
-      - move_laser
-      - fire_laser
+      - move_to_position:1
+      - enable
       - execute_experiment:experiment1
 
     post_run:
       - stop_sim
       - report_results
 
+    the config is validated before anything is set up. see plan.compile_plan
     """
+    # steps a .psycho.yaml can use, the methods marked with @action.
+    # <action>[:<data>] calls _<action>(data). set below the class
+    actions = ()
 
     _support_root = None
-
+    _home = None
+    _env_lease = None
+    _env_clone = None
+    _control = None
+    _job_root = None
+    _ready_timeout = 60
+    _max_parallel = 4
+    _sim_mode = 'host'
+    _sim_config = None
+    _plan = None
+
+    def __init__(self, job_id=None):
+        self.job_id = job_id
+        self.processes = {}
+        self.pip_timings = {}
+        self.ready_times = {}
+        self.step_timings = []
+        self.spans = []
+        self.sim_ports = {}
+        self._job_env = {}
+        self._templated_support = []
+        self._sim_sets = []
+        self._cancel_event = Event()
+
+    # records are tagged with the job id explicitly because steps run on
+    # threads that are not in the job's job_context
     def info(self, msg):
-        logger.info(msg)
+        logger.info(msg, extra={'job_id': self.job_id})
 
     def debug(self, msg):
-        logger.debug(msg)
+        logger.debug(msg, extra={'job_id': self.job_id})
 
     def critical(self, msg):
-        logger.critical(msg)
+        logger.critical(msg, extra={'job_id': self.job_id})
 
     def warning(self, msg):
-        logger.warning(msg)
+        logger.warning(msg, extra={'job_id': self.job_id})
 
     def bootstrap(self, data):
         self.info('******************* Bootstrap')
-        t = Thread(target=self._bootstrap, args=(data,))
+        t = Thread(target=self._run_job, args=(data,))
         t.setDaemon(1)
         t.start()
 
+    def run(self, data):
+        """
+        run the psychodrama in the calling thread. used by the scheduler's workers
+        """
+        self.info('******************* Run job={}'.format(self.job_id))
+        self._run_job(data)
+
     def shutdown(self):
         self.info('******************* Shutdown')
-        for k, v in self.processes.iteritems():
+        for key in self._sim_sets:
+            sim_host.remove_set(key)
+        self._sim_sets = []
+
+        if self._control:
+            for k, v in sorted(self._control.stats().items()):
+                self.info('command {} n={count} errors={errors} mean={mean:0.4f}s max={max}'.format(k, **v))
+            self._control.close()
+
+        for k, v in self.processes.items():
             self.debug('kill process {} ({})'.format(k, v))
             subprocess.call(['kill', str(v)])
 
+    def cancel(self):
+        """
+        cancel an in-flight run. called from another thread when a newer push
+        for the same branch arrives. kills every process in the processes table
+        and the run records a "superseded" result
+        """
+        self.info('******************* Cancel job={}'.format(self.job_id))
+        self._cancel_event.set()
+        self.shutdown()
+
+    def report_superseded(self, data):
+        """
+        record a "superseded" result for a queued run that never started
+        """
+        self._report('superseded by a newer push', data, time.time(), status='superseded')
+
     # private
+    def _run_job(self, data):
+        event_bus.publish('job', job_id=self.job_id, state='started',
+                          branch='/'.join(data.get('ref', '').split('/')[2:]),
+                          sha=data.get('checkout_sha'))
+        with job_context(self.job_id):
+            try:
+                self._bootstrap(data)
+            finally:
+                close_job_log(self.job_id)
+
     def _bootstrap(self, data):
         """
         example data
@@ -208,8 +354,6 @@ class PsychoDramaRunner:
         st = time.time()
         self.info('bootstrap')
 
-        self.processes = {}
-
         root = '/anaconda'
         if not os.path.isdir(root):
             root = os.path.join(os.path.expanduser('~'), 'anaconda')
@@ -232,314 +376,554 @@ class PsychoDramaRunner:
         self._make_repo(name, url, branch)
         try:
             # pull updates
-            self._pull(branch)
+            with SpanCTX(self, 'phase', 'pull'):
+                self._pull(branch, data.get('checkout_sha'))
         except BaseException, e:
-            self._report('failed to pull {}. exception={}'.format(branch, e), data, st)
+            self._fail('failed to pull {}. exception={}'.format(branch, e), data, st)
             return
+
+        try:
+            self._run_worktree(branch, data, st)
+        finally:
+            self._mirror.remove_worktree(self._root)
+
+    def _run_worktree(self, branch, data, st):
         # run .psycho.yaml
         try:
-            config = self._get_config()
-            if config is None:
-                self._report('no .psycho.yaml file present', data, st)
+            plan = self._get_plan()
+            if plan is None:
+                self._report('no .psycho.yaml file present', data, st, status='failed')
                 return
         except BaseException, e:
-            self._report('failed to get config from branch {}. exception={}'.format(branch, e), data, st)
+            self._fail('failed to get config from branch {}. exception={}'.format(branch, e), data, st)
             return
 
         try:
-            self._exec(config)
+            self._exec(plan)
         except BaseException, e:
             import traceback
             traceback.print_exc()
-            self._report('failed to run branch {}. exception={}'.format(branch, e), data, st)
-
-        self._report('run succeeded', data, st)
-        self.shutdown()
-
-    def _make_repo(self, name, url, branch, depth=10):
-        self.debug('make repo {}, {}, {}'.format(name, url, branch))
-
-        root = os.path.join(os.path.expanduser('~'), '.psychodrama')
-        if not os.path.isdir(root):
-            os.mkdir(root)
+            self._fail('failed to run branch {}. exception={}'.format(branch, e), data, st)
+        else:
+            self._report('run succeeded', data, st, status='success')
+        finally:
+            self.shutdown()
+            self._teardown_env()
+            self._teardown_job()
+
+    def _fail(self, msg, data, st):
+        if self._cancel_event.is_set():
+            self._report('superseded by a newer push', data, st, status='superseded')
+        else:
+            self._report(msg, data, st, status='failed')
 
-        root = os.path.join(root, 'repos')
-        if not os.path.isdir(root):
-            os.mkdir(root)
+    def _job_path(self, *names):
+        """
+        path inside this run's scratch directory ~/.psychodrama/jobs/<job_id>
+        """
+        if self._job_root is None:
+            self._job_root = os.path.join(os.path.expanduser('~'), '.psychodrama', 'jobs',
+                                          self.job_id or str(os.getpid()))
+            makedirs(self._job_root)
+        return os.path.join(self._job_root, *names)
+
+    def _teardown_job(self):
+        if self._job_root and os.path.isdir(self._job_root):
+            shutil.rmtree(self._job_root, ignore_errors=True)
+        self._job_root = None
+
+    def _check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise SupersededException()
+
+    def _call(self, args, line_callback=None):
+        """
+        like subprocess.check_call but the process is registered in the processes
+        table so that ``cancel`` can kill it.
 
-        self._root = os.path.join(root, name)
-        if not os.path.isdir(self._root):
-            self._repo = Repo.clone_from(url, self._root, depth=depth, branch=branch)
+        if <line_callback> is given it is called with each line of output
+        """
+        self._check_cancelled()
+        if line_callback:
+            process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
         else:
-            self._repo = Repo(self._root)
-            if branch not in self._repo.heads:
-                self._repo.create_head(branch)
+            process = subprocess.Popen(args)
 
-            head = getattr(self._repo.heads, branch)
-            head.checkout()
+        key = '{}:{}'.format(os.path.basename(args[0]), process.pid)
+        self.processes[key] = process.pid
+        try:
+            if line_callback:
+                for line in iter(process.stdout.readline, ''):
+                    line_callback(line)
+            ret = process.wait()
+        finally:
+            self.processes.pop(key, None)
+
+        self._check_cancelled()
+        if ret:
+            raise subprocess.CalledProcessError(ret, args)
+
+    def _make_repo(self, name, url, branch):
+        self.debug('make repo {}, {}, {}'.format(name, url, branch))
+        self._mirror = RepoMirror(name, url)
 
-    def _pull(self, branch):
-        self.debug('_pull')
-        origin = self._repo.remotes['origin']
-        origin.pull(branch)
+    def _pull(self, branch, sha):
+        """
+        fetch <sha> into the shared mirror and check it out into a worktree
+        private to this run
+        """
+        self.debug('_pull {} {}'.format(branch, sha))
+        sha = self._mirror.fetch(branch, sha)
+        self._root = self._mirror.add_worktree(sha, self.job_id or sha)
+        self._repo = Repo(self._root)
 
-    def _get_config(self):
+    def _get_plan(self):
+        """
+        the compiled .psycho.yaml. compiled once per version of the file
+        """
         self.debug('get config')
         p = os.path.join(self._root, '.psycho.yaml')
         if os.path.isfile(p):
             with open(p, 'r') as rfile:
-                config = yaml.load(rfile)
-            return config
+                text = rfile.read()
+            plan = plan_cache.get(text, self.actions)
+            self.debug('plan {}'.format(plan.sha))
+            return plan
 
-    def _exec(self, config):
+    def _exec(self, plan):
         self.debug('_exec')
+        self._plan = plan
+        config = plan.config
         self._endpoint = config.get('endpoint')
         if self._endpoint is None:
             raise NoEndpointException()
 
+        self._control = ControlClient(self._endpoint, timeout=config.get('control_timeout', 30))
+        self._ready_timeout = config.get('ready_timeout', 60)
+        self._max_parallel = config.get('max_parallel', 4)
+        self._sim_mode = config.get('simulator', 'host')
+        self._sim_config = config.get('simulator_config')
+
         # setup conda environment
-        self._setup_env(config)
+        with SpanCTX(self, 'phase', 'setup_env'):
+            self._setup_env(config)
 
         # setup database
-        self._setup_db(config)
+        with SpanCTX(self, 'phase', 'setup_db'):
+            self._setup_db(config)
 
         # setup support files
-        if not self._support(config):
-            raise SupportException()
+        with SpanCTX(self, 'phase', 'support'):
+            if not self._support(config):
+                raise SupportException()
 
         with SupportCTX(self._support_root):
-            if not self._pre_run(config):
-                raise PreRunException()
+            self._check_cancelled()
+            with SpanCTX(self, 'phase', 'pre_run'):
+                if not self._pre_run(config):
+                    raise PreRunException()
 
-            if not self._run(config):
-                raise RunException()
+            self._check_cancelled()
+            with SpanCTX(self, 'phase', 'run'):
+                if not self._run(config):
+                    raise RunException()
 
-            if not self._post_run(config):
-                raise PostRunException()
+            self._check_cancelled()
+            with SpanCTX(self, 'phase', 'post_run'):
+                if not self._post_run(config):
+                    raise PostRunException()
 
     def _setup_env(self, config):
+        """
+        get a conda environment for this run from the environment cache. the
+        environment is only built if the ``environment`` block has not been seen
+        before. with ``clone: true`` the run gets a private clone of the cached
+        environment instead of sharing it
+        """
         self.debug('setup env')
         env = config['environment']
         conda = os.path.join(self._conda_root, 'bin', 'conda')
 
         self.debug('env name={}'.format(env['name']))
         self.debug('conda {}'.format(conda))
-        try:
-            subprocess.check_call(
-                [conda, 'create', '--yes', '-n', env['name'], 'python'])
-        except subprocess.CalledProcessError:
-            pass
 
-        self._env_path = os.path.join(self._conda_root, 'envs', env['name'])
+        self._env_lease = lease = env_cache.acquire(self._conda_root, env,
+                                                    lambda name: self._build_env(name, env))
+        self._env_path = lease.path
+
+        if env.get('clone'):
+            name = '{}_{}'.format(env['name'], self.job_id or 'run')
+            self._call([conda, 'create', '--yes', '--offline', '-n', name, '--clone', lease.name])
+            self._env_clone = name
+            self._env_path = os.path.join(self._conda_root, 'envs', name)
+
+            lease.release()
+            self._env_lease = None
 
-        ins = [conda, 'install', '-n', env['name'], '--yes']
-        ins.extend(env['dependencies'])
-        subprocess.check_call(ins)
+    def _build_env(self, name, env):
+        self.debug('build env {}'.format(name))
+        conda = os.path.join(self._conda_root, 'bin', 'conda')
+
+        ins = [conda, 'create', '--yes', '-n', name, 'python']
+        ins.extend(env.get('dependencies') or [])
+        self._call(ins)
+
+        pips = env.get('pip')
+        if pips:
+            self._pip_install(name, pips)
+
+    def _pip_install(self, name, requirements):
+        """
+        install all pip <requirements> in one resolver pass.
 
-        pip = os.path.join(self._env_path, 'bin', 'pip')
-        for pp in env['pip']:
-            subprocess.check_call([pip, 'install', pp])
+        wheels are built into a persistent wheelhouse for the env's python and
+        installed from there, so a wheel is never rebuilt once it exists
+        """
+        python = os.path.join(self._conda_root, 'envs', name, 'bin', 'python')
+        wheelhouse = wheelhouse_path(python)
+        cache = os.path.join(os.path.expanduser('~'), '.psychodrama', 'pip-cache')
+        self.debug('pip install {} wheelhouse={}'.format(requirements, wheelhouse))
+
+        def pip(cmd, *args):
+            timer = PipTimer()
+
+            def callback(line):
+                self.debug(line.rstrip())
+                timer.feed(line)
+
+            ins = [python, '-m', 'pip', cmd, '--cache-dir', cache, '--find-links', wheelhouse]
+            ins.extend(args)
+            ins.extend(requirements)
+            try:
+                self._call(ins, line_callback=callback)
+            finally:
+                timer.finish()
+                for pkg, t in timer.report():
+                    self.pip_timings[pkg] = self.pip_timings.get(pkg, 0) + t
+                    self.info('pip {} {:<30s} {:0.2f}s'.format(cmd, pkg, t))
+                for pkg, pst, t in timer.spans():
+                    self.spans.append(('pip', pkg, 'pip_{}'.format(cmd), pst, t))
+
+        pip('wheel', '--wheel-dir', wheelhouse)
+        pip('install', '--no-index')
+
+    def _teardown_env(self):
+        if self._env_lease:
+            self._env_lease.release()
+            self._env_lease = None
+
+        if self._env_clone:
+            conda = os.path.join(self._conda_root, 'bin', 'conda')
+            try:
+                subprocess.check_call([conda, 'remove', '--yes', '--all', '-n', self._env_clone])
+            except subprocess.CalledProcessError, e:
+                self.warning('failed to remove env {}. {}'.format(self._env_clone, e))
+            self._env_clone = None
 
     def _setup_db(self, config):
+        """
+        copy the ``database`` into place from a template built from its sql.
+        see dbtemplate.DatabaseTemplates
+        """
         d = config.get('database')
         if d:
             self.debug('setup db')
-            path = d['path']
-            if os.path.isfile(path):
-                os.remove(path)
-
-            conn = sqlite3.connect(path)
-            cursor = conn.cursor()
-            for sql in d['sql']:
-                if ';' in sql:
-                    for si in sql.split(';'):
-                        cursor.execute(si)
-                else:
-                    cursor.execute(sql)
-            conn.commit()
-            conn.close()
-            self.debug('setup db complete')
+            hit = db_templates.create(d['path'], d['sql'])
+            self.debug('setup db complete. template {}'.format('hit' if hit else 'built'))
 
     def _support(self, config):
+        """
+        materialize the ``support`` entries below $HOME. unchanged files are
+        skipped, see support.SupportTree. with ``isolate_support: true`` the
+        entries go into a home directory private to this run and the app is
+        started with HOME pointing at it
+        """
         self.debug('setup support')
-        home = os.path.expanduser('~')
-
-        def r_mkdir(p):
-            if p and not os.path.isdir(p):
-                try:
-                    os.mkdir(p)
-                except OSError:
-                    r_mkdir(os.path.dirname(p))
-                    os.mkdir(p)
-
-        def make_path(s):
-            path = os.path.join(home, s['path'])
-            r_mkdir(os.path.dirname(path))
-            return path
-
-        c = config.get('support', [])
-        for sd in c:
+        if config.get('isolate_support'):
+            self._home = home = self._job_path('home')
+            tree = SupportTree(home, manifest_root=self._job_path())
+        else:
+            home = os.path.expanduser('~')
+            tree = SupportTree(home)
+
+        files, dirs = [], []
+        for sd in config.get('support', []):
             if 'text' in sd:
                 # this is a file
-                path = make_path(sd)
-                with open(path, 'w') as wfile:
-                    wfile.write(sd['text'])
+                if PLACEHOLDER_REGEX.search(sd['text']):
+                    # rewritten with the real values once they are known. see _render_support
+                    self._templated_support.append((os.path.join(home, sd['path']), sd['text']))
+                files.append((sd['path'], self._substitute(sd['text'])))
             elif 'root' in sd:
                 self._support_root = os.path.join(home, sd['root'])
             else:
                 # this is a directory
-                os.mkdir(make_path(sd))
+                dirs.append(sd['path'])
+
+        tree.materialize(files, dirs)
+        self.info('support files written={} unchanged={}'.format(tree.written, tree.skipped))
         self.debug('setup support complete')
         return True
 
+    def _substitute(self, text):
+        return PLACEHOLDER_REGEX.sub(lambda m: self._job_env.get(m.group(1), m.group(0)), text)
+
+    def _render_support(self):
+        for path, text in self._templated_support:
+            self.debug('render support file {}'.format(path))
+            atomic_write(path, self._substitute(text))
+
     def _pre_run(self, config):
         self.info('------------- Pre Run -------------')
-        c = config.get('pre_run', [])
-        return self._do_steps(c)
+        return self._do_steps('pre_run', self._plan.graphs['pre_run'])
 
     def _run(self, config):
         self.info('------------- Run -------------')
-        c = config.get('run', [])
-        return self._do_steps(c)
+        return self._do_steps('run', self._plan.graphs['run'])
 
     def _post_run(self, config):
         self.info('------------- Post Run -------------')
-        c = config.get('post_run', [])
-        return self._do_steps(c)
-
-    def _do_steps(self, steps):
-        for step in steps:
-            if ':' in step:
-                cmd, data = step.split(':')
-            else:
-                cmd, data = step, None
+        return self._do_steps('post_run', self._plan.graphs['post_run'])
 
-            getattr(self, '_{}'.format(cmd))(data)
+    def _do_steps(self, phase, graph):
+        """
+        run the steps of <phase> as a dependency graph. see dag.build_graph
+        """
+        try:
+            timings = execute(graph, self._do_step, workers=self._max_parallel)
+        except BaseException, e:
+            # keep the steps that ran so a failed run still shows its breakdown
+            self._record_steps(phase, getattr(e, 'step_timings', []))
+            raise
 
+        self._record_steps(phase, timings)
         self.debug('do steps complete')
         return True
 
-    def _report(self, msg, data, st):
-        self.info("Result message={}".format(msg))
-        duration = time.time() - st
-        conn = sqlite3.connect('/tmp/results.sqlite3')
-        cur = conn.cursor()
+    def _record_steps(self, phase, timings):
+        for name, step, st, dur in timings:
+            self.step_timings.append((phase, name, step, st, dur))
+            self.spans.append(('step', name, phase, st, dur))
+            self.info('{} step {} took {:0.2f}s'.format(phase, name, dur))
 
-        sql = '''select id from resulttbl ORDER by id desc'''
-        cur.execute(sql)
+    def _do_step(self, step):
+        self._check_cancelled()
+        if ':' in step:
+            cmd, data = step.split(':', 1)
+        else:
+            cmd, data = step, None
+
+        st = time.time()
+        event_bus.publish('step', job_id=self.job_id, name=step, state='started')
         try:
-            fid = cur.fetchone()[0]
-        except TypeError:
-            fid = 1
+            getattr(self, '_{}'.format(cmd))(data)
+        except BaseException:
+            event_bus.publish('step', job_id=self.job_id, name=step, state='failed', duration=time.time() - st)
+            raise
+        event_bus.publish('step', job_id=self.job_id, name=step, state='finished', duration=time.time() - st)
 
-        sql = '''insert into resulttbl (id, msg, pub_date, duration)
-        values ({},'{}', '{}', '{}')'''.format(fid + 1, msg, datetime.now(), duration)
+    def _report(self, msg, data, st, status=None):
+        self.info("Result message={}".format(msg))
+        duration = time.time() - st
 
-        cur.execute(sql)
-        conn.commit()
+        result_writer.write({'job_id': self.job_id,
+                             'msg': msg,
+                             'pub_date': datetime.now().strftime(DATE_FMT),
+                             'status': status,
+                             'duration': duration,
+                             'branch': '/'.join(data.get('ref', '').split('/')[2:]),
+                             'sha': data.get('checkout_sha'),
+                             'commits': json.dumps([{'id': c.get('id'),
+                                                     'message': (c.get('message') or '').split('\n')[0],
+                                                     'author': c.get('author', {}).get('name')}
+                                                    for c in data.get('commits', [])]),
+                             'spans': [(kind, name, parent, sst - st, dur)
+                                       for kind, name, parent, sst, dur in self.spans]})
 
     # actions
+    @action
     def _start_app(self, data):
         self.info('Starting App')
         name = data
         path = os.path.join(self._root, name)
-        
-        def func():
-            os.environ['PYTHONPATH'] = self._root
-            process = subprocess.Popen([os.path.join(self._env_path, 'bin', 'python'),
-                                        path],
-                                       env=os.environ)
-            self.processes[name] = process.pid
-
-        t = Thread(target=func)
-        t.setDaemon(True)
-        t.start()
-        # wait until psychodrama plugin launches
-        # timeout after 1 min
-        st = time.time()
-        while time.time() - st < 60:
-            self.info('Get Status')
-            resp = self._send_action('status')
-            if resp == 'READY':
-                break
-            time.sleep(1)
 
+        listener = ReadyListener(self._job_path('ready.sock'))
+        env = dict(os.environ,
+                   PYTHONPATH=self._root,
+                   PSYCHODRAMA_READY_SOCKET=listener.path)
+        env.update(self._job_env)
+        if self._home:
+            env['HOME'] = self._home
+        process = subprocess.Popen([os.path.join(self._env_path, 'bin', 'python'), path], env=env)
+        self.processes[name] = process.pid
+
+        # wait until psychodrama plugin launches. either the plugin connects to the
+        # ready socket or it answers READY to status. a status probe gets a short
+        # timeout of its own so an app that accepts but does not answer yet cannot
+        # hold up the backoff or outlast ready_timeout
+        deadline = time.time() + self._ready_timeout
+
+        def probe():
+            self._check_cancelled()
+            if process.poll() is not None:
+                raise NotReadyException('{} exited with {}'.format(name, process.returncode))
+            timeout = max(0.01, min(PROBE_TIMEOUT, deadline - time.time()))
+            return self._send_action('status', timeout=timeout) == 'READY'
+
+        try:
+            self._wait_ready(name, probe, listener)
+        finally:
+            listener.close()
+
+    @action
     def _start_sim(self, data):
+        """
+        start the simulators on free ports. the ports are exported to the app as
+        PSYCHODRAMA_<DEVICE>_PORT environment variables and substituted into
+        support files that reference them, e.g. ${PSYCHODRAMA_VALVE_PORT}
+
+        by default the simulators are hosted in this process. set
+        ``simulator: process`` in .psycho.yaml to run them in a separate python.
+        ``simulator_config`` in .psycho.yaml is passed to the simulators, see
+        simulator.Simulator
+        """
         name = '{}_simulator.py'.format(data)
         self.info('Starting Simulator {}'.format(name))
 
+        if self._sim_mode == 'process':
+            self._start_sim_process(data, name)
+        else:
+            key = '{}:{}'.format(self.job_id, data)
+            st = time.time()
+            self.sim_ports.update(sim_host.add_set(key, config=self._sim_config))
+            self._sim_sets.append(key)
+            self.ready_times[name] = elapsed = time.time() - st
+            self.spans.append(('ready', name, None, st, elapsed))
+            self.info('{} ready in {:0.3f}s'.format(name, elapsed))
+
+        for k, v in self.sim_ports.items():
+            self._job_env['PSYCHODRAMA_{}_PORT'.format(k.upper())] = str(v)
+        self.info('simulator ports {}'.format(self.sim_ports))
+        self._render_support()
+
+    def _start_sim_process(self, data, name):
+        ports_file = self._job_path('{}_ports.json'.format(data))
         path = os.path.join(os.path.dirname(__file__), name)
-        process = subprocess.Popen(['python', path])
+        args = ['python', path, '--ephemeral', '--ports-file', ports_file]
+        if self._sim_config:
+            config_file = self._job_path('{}_config.yaml'.format(data))
+            with open(config_file, 'w') as wfile:
+                yaml.safe_dump(self._sim_config, wfile)
+            args.extend(('--config', config_file))
+
+        process = subprocess.Popen(args)
         self.processes[name] = process.pid
-        time.sleep(2)
 
+        def probe():
+            self._check_cancelled()
+            if process.poll() is not None:
+                raise NotReadyException('{} exited with {}'.format(name, process.returncode))
+
+            if os.path.isfile(ports_file):
+                with open(ports_file, 'r') as rfile:
+                    ports = json.load(rfile)
+                if all(probe_tcp('127.0.0.1', p) for p in ports.values()):
+                    self.sim_ports.update(ports)
+                    return True
+
+        self._wait_ready(name, probe)
+
+    def _wait_ready(self, name, probe, listener=None):
+        elapsed = wait_for(probe, timeout=self._ready_timeout, listener=listener)
+        if elapsed is None:
+            raise NotReadyException('{} not ready after {}s'.format(name, self._ready_timeout))
+
+        self.ready_times[name] = elapsed
+        self.spans.append(('ready', name, None, time.time() - elapsed, elapsed))
+        self.info('{} ready in {:0.2f}s'.format(name, elapsed))
+
+    @action
     def _stop_sim(self, data):
-        pass
+        if data is None:
+            keys = list(self._sim_sets)
+        else:
+            keys = ['{}:{}'.format(self.job_id, data)]
 
+        for key in keys:
+            self.info('Stopping Simulator {}'.format(key))
+            sim_host.remove_set(key)
+            if key in self._sim_sets:
+                self._sim_sets.remove(key)
+
+        if self._sim_mode == 'process':
+            for k in self.processes.keys():
+                if k.endswith('_simulator.py') and (data is None or k.startswith(data)):
+                    subprocess.call(['kill', str(self.processes.pop(k))])
+
+    @action
     def _report_results(self, data):
         pass
 
+    @action
     def _test_simulator(self, data):
         """
-        data should be string in form of <SimulatorKlass>, <port>
+        data should be string in form of <SimulatorKlass>[, <port>]
         e.g.
            Valve, 8000
+        the port of a simulator started by start_sim takes precedence
+
         :param data:
         :return:
         """
         self.info('test simulator. data={}'.format(data))
-        klass, port = map(str.strip, data.split(','))
+        args = map(str.strip, data.split(','))
+        klass = args[0]
+        port = self.sim_ports.get(klass, args[1] if len(args) > 1 else None)
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.connect(('127.0.0.1', int(port)))
         cmd = {'Valve': ('Open A', 'OK'),
                'Laser': ('Enable', 'OK')}.get(klass)
         if cmd:
             cmd, resp = cmd
-            s.send(cmd)
+            s.send('{}\r\n'.format(cmd))
             data = s.recv(4096)
             self.info('{} ==> {}, expected={}'.format(cmd, data, resp))
             s.close()
 
             assert (data.strip() == resp)
 
+    @action
     def _move_to_position(self, data):
         resp = self._send_action('MoveToPosition {}'.format(data))
         assert (resp == 'OK')
 
+    @action
     def _enable(self, data):
         resp = self._send_action('Enable')
         assert (resp == 'OK')
 
+    @action
     def _disable(self, data):
         resp = self._send_action('Disable')
         assert (resp == 'OK')
 
+    @action
     def _execute_experiment(self, data):
         resp = self._send_action('ExecuteExperiment', data=data)
         assert (resp == 'OK')
 
-    def _send_action(self, command, **kw):
+    def _send_action(self, command, timeout=None, **kw):
         self.debug('send action command: {}'.format(command))
-
-        kw['command'] = command
-        action = json.dumps(kw)
-
-        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         try:
-            self.debug('connect to {}'.format(self._endpoint))
-            s.connect(self._endpoint)
-        except BaseException, e:
+            resp = self._control.send(command, timeout=timeout, **kw)
+        except (socket.error, ControlError), e:
             self.critical(e)
             return
 
-        s.settimeout(0.5)
+        self.debug('Send Action {}==>{}'.format(command, resp))
+        return resp
 
-        cmd = '{:02X}{}'.format(len(action), action)
-        s.send(cmd)
-        resp = s.recv(1024)
-        s.close()
 
-        self.debug('Send Action {}==>{}'.format(cmd, resp))
-        return resp
+PsychoDramaRunner.actions = action_names(PsychoDramaRunner)
 
 # ============= EOF =============================================
@@ -0,0 +1,167 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import logging
+import time
+import uuid
+from Queue import Queue, Full
+from threading import Thread, Lock
+# ============= local library imports  ==========================
+from joblog import job_context
+from runner import PsychoDramaRunner
+
+logger = logging.getLogger('psychodrama_scheduler')
+logger.setLevel(logging.DEBUG)
+
+
+class Job(object):
+    def __init__(self, data):
+        self.id = uuid.uuid4().hex[:12]
+        self.data = data
+        self.submitted = time.time()
+
+        ref = data.get('ref', '')
+        self.branch = '/'.join(ref.split('/')[2:])
+
+
+class RunScheduler(object):
+    """
+    runs psychodramas on a fixed pool of worker threads.
+
+    jobs wait in a bounded queue. if the queue is full ``submit`` returns None
+    and the webhook tells the sender to try again later
+
+    runs are coalesced per branch. a push for a branch that already has a
+    queued job replaces that job's payload and a push for a branch with a
+    running job cancels the running job. only the newest checkout_sha is run,
+    the others are recorded as "superseded"
+    """
+
+    def __init__(self, workers=1, queue_size=10):
+        self._nworkers = workers
+        self._queue = Queue(maxsize=queue_size)
+        self._lock = Lock()
+        self._workers = []
+        self._pending = {}
+        self._active = {}
+
+        self._running = 0
+        self._accepted = 0
+        self._rejected = 0
+        self._completed = 0
+        self._superseded = 0
+        self._wait_total = 0
+        self._wait_max = 0
+        self._wait_last = 0
+
+    def start(self):
+        logger.info('starting {} workers. queue size={}'.format(self._nworkers, self._queue.maxsize))
+        for i in range(self._nworkers):
+            t = Thread(target=self._work, name='worker-{}'.format(i))
+            t.setDaemon(True)
+            t.start()
+            self._workers.append(t)
+
+    def submit(self, data):
+        job = Job(data)
+        stale = None
+        with self._lock:
+            pending = self._pending.get(job.branch)
+            if pending:
+                # coalesce. the queued job keeps its place in the queue but runs the newest push
+                logger.info('job {} supersedes queued payload for branch {}'.format(pending.id, job.branch))
+                stale, pending.data = pending.data, data
+                self._accepted += 1
+                self._superseded += 1
+                ret = pending
+            else:
+                try:
+                    self._queue.put_nowait(job)
+                except Full:
+                    # leave the running job alone, the sender will try again
+                    self._rejected += 1
+                    logger.warning('queue full. rejected job for branch {}'.format(job.branch))
+                    return
+
+                self._pending[job.branch] = job
+                self._accepted += 1
+                logger.info('queued job {} for branch {}. depth={}'.format(job.id, job.branch,
+                                                                          self._queue.qsize()))
+                ret = job
+
+            active = self._active.get(job.branch)
+            if active:
+                self._superseded += 1
+
+        # cancelling kills processes and tears down simulators. do it without
+        # holding the lock so other requests are not stalled
+        if active:
+            logger.info('cancel running job {} for branch {}'.format(active.job_id, job.branch))
+            active.cancel()
+
+        if stale is not None:
+            PsychoDramaRunner(pending.id).report_superseded(stale)
+        return ret
+
+    def metrics(self):
+        with self._lock:
+            started = self._running + self._completed
+            return {'workers': self._nworkers,
+                    'queue_size': self._queue.maxsize,
+                    'queue_depth': self._queue.qsize(),
+                    'running': self._running,
+                    'accepted': self._accepted,
+                    'rejected': self._rejected,
+                    'completed': self._completed,
+                    'superseded': self._superseded,
+                    'active_branches': sorted(self._active.keys()),
+                    'wait_mean': self._wait_total / started if started else 0,
+                    'wait_max': self._wait_max,
+                    'wait_last': self._wait_last}
+
+    # private
+    def _work(self):
+        while 1:
+            job = self._queue.get()
+            wait = time.time() - job.submitted
+            runner = PsychoDramaRunner(job.id)
+            with self._lock:
+                self._pending.pop(job.branch, None)
+                self._active[job.branch] = runner
+                self._running += 1
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
+                self._wait_last = wait
+
+            try:
+                with job_context(job.id):
+                    logger.info('starting job {} for branch {}. waited {:0.1f}s'.format(job.id, job.branch,
+                                                                                         wait))
+                    try:
+                        runner.run(job.data)
+                    except BaseException:
+                        logger.exception('job {} failed'.format(job.id))
+            finally:
+                with self._lock:
+                    if self._active.get(job.branch) is runner:
+                        self._active.pop(job.branch)
+                    self._running -= 1
+                    self._completed += 1
+                self._queue.task_done()
+
+# ============= EOF =============================================
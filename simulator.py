@@ -15,18 +15,69 @@
 # ===============================================================================
 
 # ============= enthought library imports =======================
+import json
 import logging
+import os
+from threading import Thread, Lock
 
 
 # ============= standard library imports ========================
 # ============= local library imports  ==========================
 from twisted.internet import reactor
-from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.internet.defer import DeferredList
+from twisted.internet.error import CannotListenError
+from twisted.internet.threads import blockingCallFromThread
+
+# name, factory, legacy fixed port
+DEVICES = (('Valve', 'ValveFactory', 8000),
+           ('Laser', 'LaserFactory', 8001),
+           ('Spectrometer', 'SpectrometerFactory', 8002))
 
 
 class Simulator:
-    def __init__(self):
+    """
+    by default each device listens on its legacy fixed port. with
+    <ephemeral> the OS picks free ports, with <port_pool> the first free port in
+    the pool is used. the ports actually bound are in ``ports`` and are written
+    as json to <ports_file> so the runner can pick them up
+
+    <config> has one section per device, passed to the device's factory e.g.
+        Spectrometer:
+          isotopes:
+            Ar40: 100
+            Ar36: 0.3
+          noise: 0.01
+        Valve:
+          latency:
+            default:
+              fixed: 0.01
+            Open:
+              distribution: normal
+              mean: 0.5
+              sigma: 0.05
+
+    see protocols.latency for the latency models.
+
+    a device section with ``replay`` serves the exchanges of a traffic log
+    recorded with recorder.py instead of simulating the device e.g.
+        Valve:
+          replay:
+            path: valve.pdtl
+            speed: 10
+
+    see protocols.replay
+    """
+
+    def __init__(self, host='127.0.0.1', ephemeral=False, port_pool=None, ports_file=None, config=None):
         self.logger = logging.getLogger('Simulator')
+        self.config = config or {}
+        self.host = host
+        self.ephemeral = ephemeral
+        self.port_pool = port_pool
+        self.ports_file = ports_file
+        self.ports = {}
+        self.factories = {}
+        self._listening = []
 
     def bootstrap(self):
         # load configuration
@@ -35,16 +86,71 @@ class Simulator:
         # start reactor
         self._start_reactor()
 
+    def listen(self):
+        """
+        start listening without running the reactor. must be called in the reactor thread
+
+        :return: dict of device name: port
+        """
+        self._load_configuration()
+        return dict(self.ports)
+
+    def stop(self):
+        """
+        stop listening and drop all connections. must be called in the reactor thread
+
+        :return: Deferred that fires when every port is closed
+        """
+        ds = []
+        for port in self._listening:
+            port.factory.disconnect_all()
+            ds.append(port.stopListening())
+        self._listening = []
+        return DeferredList(ds)
+
+    def stats(self):
+        """
+        :return: dict of device name: command statistics
+        """
+        return dict((k, f.stats.snapshot()) for k, f in self.factories.items())
+
     # private
     def _load_configuration(self):
 
-        for f, p in (('ValveFactory', 8000),
-                     ('LaserFactory', 8001),
-                     ('SpectrometerFactory', 8002)):
+        for name, f, p in DEVICES:
+            cfg = self.config.get(name)
+            if cfg and 'replay' in cfg:
+                f = 'ReplayFactory'
+
             mod = __import__('protocols', fromlist=[f])
             klass = getattr(mod, f)
-            endpoint = TCP4ServerEndpoint(reactor, p)
-            endpoint.listen(klass())
+            factory = klass(cfg)
+            port = self._listen(factory, p)
+            self.factories[name] = factory
+            self._listening.append(port)
+            self.ports[name] = port.getHost().port
+            self.info('{} listening on {}'.format(name, self.ports[name]))
+
+        if self.ports_file:
+            self._write_ports()
+
+    def _listen(self, factory, default):
+        if self.port_pool:
+            for p in self.port_pool:
+                try:
+                    return reactor.listenTCP(p, factory, interface=self.host)
+                except CannotListenError:
+                    continue
+            raise CannotListenError(self.host, self.port_pool, 'port pool exhausted')
+
+        return reactor.listenTCP(0 if self.ephemeral else default, factory, interface=self.host)
+
+    def _write_ports(self):
+        # write then rename so a reader never sees a partial file
+        tmp = '{}.tmp'.format(self.ports_file)
+        with open(tmp, 'w') as wfile:
+            json.dump(self.ports, wfile)
+        os.rename(tmp, self.ports_file)
 
     def _start_reactor(self):
         reactor.run()
@@ -58,4 +164,74 @@ class Simulator:
     def warning(self, msg):
         self.logger.info(msg)
 
+
+class SimulatorHost(object):
+    """
+    hosts simulator sets inside a long lived process.
+
+    the reactor runs once, in a background thread. ``add_set`` starts a new set
+    of device simulators on free ports in milliseconds and ``remove_set`` tears
+    it down again, so a run does not pay for a new interpreter, importing
+    twisted and setting up a reactor
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('SimulatorHost')
+        self._sets = {}
+        self._thread = None
+        self._lock = Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=reactor.run,
+                                      kwargs={'installSignalHandlers': False},
+                                      name='simulator-host')
+                self._thread.setDaemon(True)
+                self._thread.start()
+
+    def add_set(self, key, host='127.0.0.1', port_pool=None, config=None):
+        """
+        :param key: unique name for the set e.g. <job_id>:<simulator>
+        :param config: see Simulator
+        :return: dict of device name: port
+        """
+        self.start()
+        return blockingCallFromThread(reactor, self._add_set, key, host, port_pool, config)
+
+    def remove_set(self, key):
+        if key in self._sets:
+            blockingCallFromThread(reactor, self._remove_set, key)
+
+    def keys(self):
+        return self._sets.keys()
+
+    def stats(self):
+        """
+        :return: dict of set key: device name: command statistics
+        """
+        if self._thread is None:
+            return {}
+        return blockingCallFromThread(reactor, self._stats)
+
+    # private
+    def _add_set(self, key, host, port_pool, config):
+        sim = Simulator(host=host, ephemeral=True, port_pool=port_pool, config=config)
+        ports = sim.listen()
+        self._sets[key] = sim
+        self.logger.info('added simulator set {} {}'.format(key, ports))
+        return ports
+
+    def _stats(self):
+        return dict((k, sim.stats()) for k, sim in self._sets.items())
+
+    def _remove_set(self, key):
+        sim = self._sets.pop(key, None)
+        if sim:
+            self.logger.info('removed simulator set {}'.format(key))
+            return sim.stop()
+
+
+sim_host = SimulatorHost()
+
 # ============= EOF =============================================
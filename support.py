@@ -0,0 +1,193 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import stat
+import tempfile
+from Queue import Queue, Empty
+from threading import Thread
+# ============= local library imports  ==========================
+from fileutil import makedirs, open_lock
+
+logger = logging.getLogger('psychodrama_support')
+logger.setLevel(logging.DEBUG)
+
+MANIFEST_ROOT = os.path.join(os.path.expanduser('~'), '.psychodrama', 'support')
+
+# read once at import. os.umask can only be read by setting it, which is not
+# safe once several threads are writing files
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def content_hash(text):
+    return hashlib.sha1(text).hexdigest()
+
+
+def atomic_write(path, text):
+    """
+    write <text> to a temporary file next to <path> and rename it into place so
+    readers see either the old or the new file, never a partial one.
+
+    the file keeps the mode of the file it replaces. a new file gets the
+    default mode for the umask, not mkstemp's 0600
+    """
+    head, tail = os.path.split(path)
+    makedirs(head)
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        mode = 0666 & ~UMASK
+
+    fd, tmp = tempfile.mkstemp(prefix='.{}.'.format(tail), dir=head)
+    try:
+        with os.fdopen(fd, 'w') as wfile:
+            wfile.write(text)
+        os.chmod(tmp, mode)
+        os.rename(tmp, path)
+    except BaseException:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        raise
+
+
+class SupportTree(object):
+    """
+    materializes support files below <root>.
+
+    a manifest remembers the content hash, size and mtime of every file written.
+    a file whose content hash did not change and that was not touched since is
+    skipped. writes are atomic and more than <parallel_threshold> files are
+    written on a pool of <workers> threads. the manifest is guarded by a file
+    lock so runs sharing a root do not interleave. the manifest and lock live in
+    <manifest_root>
+    """
+
+    def __init__(self, root, workers=8, parallel_threshold=32, manifest_root=MANIFEST_ROOT):
+        self.root = root
+        self.workers = workers
+        self.parallel_threshold = parallel_threshold
+        self.written = 0
+        self.skipped = 0
+
+        key = content_hash(os.path.abspath(root))[:12]
+        self._manifest_root = manifest_root
+        self._manifest_path = os.path.join(manifest_root, 'manifest-{}.json'.format(key))
+        self._lock_path = os.path.join(manifest_root, 'manifest-{}.lock'.format(key))
+
+    def path(self, rel):
+        return os.path.join(self.root, rel)
+
+    def materialize(self, files, dirs=None):
+        """
+        :param files: list of (relative path, text)
+        :param dirs: list of relative directory paths
+        """
+        fd = open_lock(self._lock_path)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            manifest = self._load_manifest()
+            makedirs(self.root)
+            for d in dirs or []:
+                makedirs(self.path(d))
+
+            todo = []
+            for rel, text in files:
+                h = content_hash(text)
+                if self._unchanged(manifest.get(rel), h, self.path(rel)):
+                    self.skipped += 1
+                else:
+                    todo.append((rel, text, h))
+
+            if len(todo) > self.parallel_threshold:
+                entries = self._write_parallel(todo)
+            else:
+                entries = [self._write(*t) for t in todo]
+
+            for rel, entry in entries:
+                manifest[rel] = entry
+            self.written += len(entries)
+            self._dump_manifest(manifest)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+        logger.debug('support {} written={} skipped={}'.format(self.root, self.written, self.skipped))
+
+    # private
+    def _unchanged(self, entry, h, path):
+        if not entry or entry['hash'] != h:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return st.st_size == entry['size'] and st.st_mtime == entry['mtime']
+
+    def _write(self, rel, text, h):
+        path = self.path(rel)
+        atomic_write(path, text)
+        st = os.stat(path)
+        return rel, {'hash': h, 'size': st.st_size, 'mtime': st.st_mtime}
+
+    def _write_parallel(self, todo):
+        q = Queue()
+        for t in todo:
+            q.put(t)
+
+        results = []
+        errors = []
+
+        def work():
+            while 1:
+                try:
+                    t = q.get_nowait()
+                except Empty:
+                    break
+                try:
+                    results.append(self._write(*t))
+                except BaseException, e:
+                    errors.append(e)
+
+        threads = [Thread(target=work, name='support-{}'.format(i)) for i in range(self.workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise errors[0]
+        return results
+
+    def _load_manifest(self):
+        if os.path.isfile(self._manifest_path):
+            try:
+                with open(self._manifest_path, 'r') as rfile:
+                    return json.load(rfile)
+            except ValueError:
+                logger.warning('corrupt support manifest {}'.format(self._manifest_path))
+        return {}
+
+    def _dump_manifest(self, manifest):
+        atomic_write(self._manifest_path, json.dumps(manifest))
+
+# ============= EOF =============================================
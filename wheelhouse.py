@@ -0,0 +1,106 @@
+# ===============================================================================
+# Copyright 2016 Jake Ross
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+# ============= enthought library imports =======================
+# ============= standard library imports ========================
+import os
+import re
+import subprocess
+import time
+# ============= local library imports  ==========================
+from fileutil import makedirs
+
+PACKAGE_REGEX = re.compile(r'^\s*(Collecting|Building wheel for|Processing|Saved)\s+(\S+)')
+NAME_REGEX = re.compile(r'[<>=!~\[;( ]')
+INSTALL_REGEX = re.compile(r'^\s*Installing collected packages')
+
+
+def wheelhouse_path(python, root=None):
+    """
+    directory of wheels built for <python>. wheels are not portable between
+    interpreter versions so there is one wheelhouse per python tag e.g. py27
+    """
+    if root is None:
+        root = os.path.join(os.path.expanduser('~'), '.psychodrama', 'wheelhouse')
+
+    tag = subprocess.check_output([python, '-c',
+                                   'import sys;print("py{}{}".format(*sys.version_info[:2]))'])
+    path = os.path.join(root, tag.strip())
+    makedirs(path)
+    return path
+
+
+def package_name(token):
+    """
+    normalized package name from a requirement, a path to a wheel or an sdist
+    """
+    token = os.path.basename(token)
+    if token.endswith('.whl'):
+        token = token.split('-')[0]
+    else:
+        token = NAME_REGEX.split(token)[0]
+        if token.endswith(('.tar.gz', '.zip')):
+            token = token.rsplit('-', 1)[0]
+    return token.lower().replace('_', '-')
+
+
+class PipTimer(object):
+    """
+    attribute the wall time of a single pip invocation to individual packages.
+
+    feed it pip's output line by line. the time between a line that names a
+    package (Collecting, Building wheel for, ...) and the next such line is
+    charged to that package
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.starts = {}
+        self._current = None
+        self._st = None
+
+    def feed(self, line):
+        m = PACKAGE_REGEX.match(line)
+        if m:
+            self._charge()
+            self._current = package_name(m.group(2))
+        elif INSTALL_REGEX.match(line):
+            # the final install step is shared by every package
+            self._charge()
+            self._current = 'install'
+
+    def finish(self):
+        self._charge()
+        self._current = None
+
+    def report(self):
+        return sorted(self.timings.items(), key=lambda kv: kv[1], reverse=True)
+
+    def spans(self):
+        """
+        :return: list of (package, first seen, total time) in the order pip got to them
+        """
+        return sorted(((k, self.starts[k], t) for k, t in self.timings.items()), key=lambda s: s[1])
+
+    # private
+    def _charge(self):
+        now = time.time()
+        if self._current:
+            self.timings[self._current] = self.timings.get(self._current, 0) + now - self._st
+            self.starts.setdefault(self._current, self._st)
+        self._st = now
+
+# ============= EOF =============================================
@@ -17,6 +17,8 @@
 # ============= enthought library imports =======================
 # ============= standard library imports ========================
 # ============= local library imports  ==========================
+# serve with gunicorn -c gunicorn.conf.py wsgi:app. the default sync workers
+# are blocked by the /events streams
 from psychodrama import bootstrap
 app = bootstrap()
 